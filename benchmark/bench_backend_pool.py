@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+"""
+多代理路由测试，启动多个模拟代理，检查按权重分配新任务、故障代理被跳过、变换任务发送到原代理
+
+在chatgpt-on-wechat项目主目录下运行：
+    python -m plugins.midjourney_turbo.benchmark.bench_backend_pool --tasks 60
+"""
+import argparse
+import time
+from collections import Counter
+
+from plugins.midjourney_turbo.benchmark.stub_proxy import StubProxy
+from plugins.midjourney_turbo.lib.backend_pool import BackendPool, parse_backends
+from plugins.midjourney_turbo.lib.resilience import ProxyError
+
+
+def submit_round(pool, count):
+    owners = Counter()
+    task_ids = []
+    for i in range(count):
+        submit_data = pool.get_imagine(prompt="bench %d" % i)
+        if isinstance(submit_data, ProxyError):
+            owners["error"] += 1
+            continue
+        owners[submit_data["backend"]] += 1
+        task_ids.append(submit_data["result"])
+    return owners, task_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description="backend pool routing test")
+    parser.add_argument("--tasks", type=int, default=60)
+    args = parser.parse_args()
+
+    stubs = [StubProxy(render_delay=0.5).start() for _ in range(3)]
+    config = [{"name": "mj%d" % i, "domain_name": stub.url, "weight": weight}
+              for i, (stub, weight) in enumerate(zip(stubs, [2, 1, 1]))]
+    pool = BackendPool(parse_backends(config), probe_interval=0.5, min_samples=3, reset_timeout=0.5)
+
+    owners, task_ids = submit_round(pool, args.tasks)
+    print("weighted routing (2:1:1):", dict(owners))
+    assert owners["mj0"] > owners["mj1"] and owners["mj0"] > owners["mj2"]
+
+    # 任务结束后进行中任务数归零
+    time.sleep(0.6)
+    pool.list_by_condition(task_ids)
+    print("after completion:", pool.stats())
+    assert all(stat["outstanding"] == 0 for stat in pool.stats().values())
+
+    # 变换任务发送到原任务所在的代理
+    parent = pool.get_imagine(prompt="parent")
+    counts = {stub.url: stub.counters["submit"] for stub in stubs}
+    child = pool.get_simple("%s U1" % parent["result"])
+    moved = [stub.url for stub in stubs if stub.counters["submit"] != counts[stub.url]]
+    print("parent on %s, child on %s" % (parent["backend"], child["backend"]))
+    assert child["backend"] == parent["backend"] and moved == [pool.by_name[parent["backend"]].mm.domain_name]
+
+    # 一个代理故障后，错误率超限或探测失败时不再分配新任务
+    stubs[0].fail_rate = 1.0
+    owners, _ = submit_round(pool, args.tasks)
+    print("mj0 down:", dict(owners), pool.stats())
+    assert owners["mj0"] <= pool.min_samples
+
+    time.sleep(1.2)
+    owners, _ = submit_round(pool, args.tasks)
+    print("after probe:", dict(owners))
+    assert owners["mj0"] == 0 and owners["error"] == 0
+
+    # 代理恢复后，探测成功即重新参与分配
+    stubs[0].fail_rate = 0.0
+    time.sleep(1.2)
+    owners, _ = submit_round(pool, args.tasks)
+    print("mj0 recovered:", dict(owners))
+    assert owners["mj0"] > 0
+
+    for stub in stubs:
+        stub.stop()
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+"""
+合图提交的内存基准测试，对比整体构建base64字符串和流式请求体两种方式的内存峰值
+
+在chatgpt-on-wechat项目主目录下运行：
+    python -m plugins.midjourney_turbo.benchmark.bench_blend_memory --images 5 --size 3000
+"""
+import argparse
+import base64
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from PIL import Image
+
+from plugins.midjourney_turbo.benchmark import stub_proxy
+from plugins.midjourney_turbo.lib.midJourney_module import ImageSource, MidJourneyModule
+
+
+# 生成测试图片，使用随机噪点让JPEG难以压缩，接近手机照片的大小
+def make_images(count, size):
+    directory = tempfile.mkdtemp()
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, "%d.jpg" % i)
+        Image.frombytes("RGB", (size, size * 3 // 4), os.urandom(size * size * 3 // 4 * 3)).save(path, quality=95)
+        paths.append(path)
+    return paths
+
+
+# 原有方式：每张图片构建完整的base64字符串，再整体序列化为JSON
+def legacy_blend(mm, paths):
+    base64_data = []
+    for path in paths:
+        with open(path, "rb") as f:
+            base64_data.append('data:image/png;base64,' + base64.b64encode(f.read()).decode('utf-8'))
+    data = {"base64Array": base64_data, "dimensions": "SQUARE", "notifyHook": "", "state": ""}
+    return mm.session.post(f"{mm.domain_name}/mj/submit/blend", headers=mm.json_headers,
+                           data=json.dumps(data), timeout=mm.timeout).json()
+
+
+# 流式方式：请求体由图片文件逐块编码生成
+def streaming_blend(mm, paths):
+    return mm.submit_blend([ImageSource(mime="image/jpeg", path=path) for path in paths])
+
+
+def measure(name, func, mm, paths):
+    tracemalloc.start()
+    start = time.time()
+    result = func(mm, paths)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert result.get("code") == 1, result
+    print("%-10s peak %8.1f MB  time %.2fs" % (name, peak / 1024 / 1024, elapsed))
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="blend submission memory benchmark")
+    parser.add_argument("--images", type=int, default=5)
+    parser.add_argument("--size", type=int, default=3000, help="longest edge of generated images")
+    args = parser.parse_args()
+
+    paths = make_images(args.images, args.size)
+    payload = sum(os.path.getsize(path) for path in paths)
+    # 代理在子进程中运行，接收请求体的内存不计入测量结果
+    process, url = stub_proxy.spawn()
+    try:
+        mm = MidJourneyModule(api_key="", domain_name=url)
+        print("%d images, %.1f MB on disk, %.1f MB as base64" % (args.images, payload / 1024 / 1024,
+                                                                 payload * 4 / 3 / 1024 / 1024))
+        legacy = measure("legacy", legacy_blend, mm, paths)
+        streaming = measure("streaming", streaming_blend, mm, paths)
+        print("peak memory reduced by %.1fx" % (legacy / max(streaming, 1)))
+    finally:
+        process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+"""
+插件导入耗时测试：在新的解释器中先导入项目本身的模块，再计时导入插件，检查PIL、openai和未使用的频道模块是否被延迟导入
+
+同时计时这些模块单独导入的耗时，即改为延迟导入后启动和热重载插件时节省的时间。在chatgpt-on-wechat项目主目录下运行：
+    python -m plugins.midjourney_turbo.benchmark.bench_import --runs 10
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# 插件导入时不应加载的模块，第一次使用时才导入
+DEFERRED = ["PIL.Image", "PIL.ImageOps", "openai", "channel.wechat.wechat_channel", "channel.wechatmp.wechatmp_channel",
+            "channel.wechatcom.wechatcomapp_channel"]
+
+SNIPPET = """
+import importlib, json, sys, time
+import config, plugins, bridge.context, bridge.reply, common.log, requests
+start = time.perf_counter()
+import plugins.midjourney_turbo.midjourney_turbo
+plugin_import = time.perf_counter() - start
+deferred = %r
+loaded = [name for name in deferred if name in sys.modules]
+start = time.perf_counter()
+for name in deferred:
+    try:
+        importlib.import_module(name)
+    except Exception:
+        pass
+deferred_import = time.perf_counter() - start
+print(json.dumps({"plugin_import": plugin_import, "deferred_import": deferred_import, "loaded": loaded}))
+""" % DEFERRED
+
+
+# 在新的解释器中导入一次插件
+def run_once():
+    output = subprocess.run([sys.executable, "-c", SNIPPET], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+# 使用-X importtime列出导入插件时最耗时的模块
+def top_imports(count):
+    code = "import config, plugins, bridge.context, bridge.reply, common.log, requests\n" \
+           "import plugins.midjourney_turbo.midjourney_turbo"
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1].strip()), parts[2].rstrip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="plugin import time benchmark")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10, help="show the slowest imports, 0 to skip")
+    args = parser.parse_args()
+
+    results = [run_once() for _ in range(args.runs)]
+    plugin_ms = [r["plugin_import"] * 1000 for r in results]
+    deferred_ms = [r["deferred_import"] * 1000 for r in results]
+    print("plugin import: median %.1f ms, min %.1f ms" % (statistics.median(plugin_ms), min(plugin_ms)))
+    print("deferred modules (%s): median %.1f ms saved at load time" % (", ".join(DEFERRED),
+                                                                         statistics.median(deferred_ms)))
+    loaded = results[-1]["loaded"]
+    print("deferred modules loaded by the plugin import: %s" % (loaded or "none"))
+
+    if args.top:
+        print("\nslowest cumulative imports (us):")
+        for cumulative, name in top_imports(args.top):
+            print("%10d %s" % (cumulative, name))
+    if loaded:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+"""
+端到端压力测试：模拟代理 + 模拟消息通道 + 合成请求，测量不同并发用户数下的吞吐、处理线程占用、端到端耗时和内存峰值
+
+每个用户循环发送请求并等待最终结果，请求按比例混合出图、变换和合图。在chatgpt-on-wechat项目主目录下运行：
+    python -m plugins.midjourney_turbo.benchmark.bench_load --users 1 10 100 --requests 5 --render-delay 2
+"""
+import argparse
+import json
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from bridge.context import ContextType
+from bridge.reply import ReplyType
+from plugins.midjourney_turbo.benchmark import stub_proxy
+from plugins.midjourney_turbo.benchmark.harness import NOTICE_PREFIXES, FakeChannel, create_plugin, make_context, \
+    make_image
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class LoadRun:
+    # 一轮测试，users个并发用户各发送requests个请求
+    def __init__(self, plugin, channel, users, requests, mix, workdir, timeout, seed=0):
+        self.plugin = plugin
+        self.channel = channel
+        self.users = users
+        self.requests = requests
+        self.mix = mix
+        self.workdir = workdir
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.handler_times = []
+        self.latencies = []
+        self.outcomes = {"ok": 0, "error": 0, "timeout": 0}
+        self.errors = Counter()  # 错误提示的开头 -> 次数
+        self.peak_threads = 0
+        self.running = True
+
+    # 调用插件的事件处理函数，记录处理线程的占用时间
+    def handle(self, e_context):
+        start = time.perf_counter()
+        self.plugin.on_handle_context(e_context)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.handler_times.append(elapsed)
+        return e_context["reply"]
+
+    # 发送一个请求并等待最终结果
+    def request(self, session_id, kind, last_task):
+        start = time.time()
+        if kind == "change" and last_task:
+            reply = self.handle(make_context("/c %s %s" % (last_task, self.random.choice(["U1", "V2"])), session_id))
+        elif kind == "blend":
+            reply = self.handle(make_context("/b 2", session_id))
+            if reply is not None and reply.type == ReplyType.INFO:
+                # 每次使用不同的图片，避免合图请求被合并
+                for _ in range(2):
+                    color = self.random_color()
+                    path = make_image(self.workdir, 512, "blend_%d_%d_%d.jpg" % color, color)
+                    reply = self.handle(make_context(path, session_id, ContextType.IMAGE))
+        else:
+            reply = self.handle(make_context("bench %s %d" % (session_id, self.random.random() * 1e9), session_id))
+        # 处理函数直接返回了错误提示，相同任务合并的提示之后仍会收到结果
+        content = str(reply.content).strip() if reply is not None and reply.content else ""
+        if content and reply.type in (ReplyType.TEXT, ReplyType.ERROR) and not content.startswith(NOTICE_PREFIXES):
+            return self.error(reply.content), None
+        result = self.channel.wait_result(session_id, self.timeout)
+        if result is None:
+            return "timeout", None
+        got_image, content, task_id = result
+        if not got_image:
+            return self.error(content), task_id
+        with self.lock:
+            self.latencies.append(time.time() - start)
+        return "ok", task_id
+
+    def random_color(self):
+        with self.lock:
+            return tuple(self.random.randrange(256) for _ in range(3))
+
+    def error(self, content):
+        with self.lock:
+            self.errors[str(content).strip()[:24]] += 1
+        return "error"
+
+    def user(self, index):
+        session_id = "bench_user_%d" % index
+        last_task = None
+        kinds, weights = zip(*self.mix.items())
+        for _ in range(self.requests):
+            kind = self.random.choices(kinds, weights)[0]
+            outcome, task_id = self.request(session_id, kind, last_task)
+            last_task = task_id if outcome == "ok" and kind == "imagine" else last_task
+            with self.lock:
+                self.outcomes[outcome] += 1
+
+    def monitor(self):
+        while self.running:
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            time.sleep(0.05)
+
+    def run(self):
+        tracemalloc.start()
+        monitor = threading.Thread(target=self.monitor, daemon=True)
+        monitor.start()
+        start = time.time()
+        threads = [threading.Thread(target=self.user, args=(i,)) for i in range(self.users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.time() - start
+        self.running = False
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        completed = sum(self.outcomes.values())
+        return {
+            "users": self.users,
+            "requests": completed,
+            **self.outcomes,
+            "wall_s": round(wall, 2),
+            "rps": round(completed / wall, 2),
+            # 处理线程占用率：所有处理函数的耗时之和 / (测试时长 * 用户数)
+            "handler_occupancy": round(sum(self.handler_times) / (wall * self.users), 4),
+            "handler_p99_ms": round(percentile(self.handler_times, 0.99) * 1000, 1),
+            "e2e_p50_s": round(percentile(self.latencies, 0.5), 2),
+            "e2e_p95_s": round(percentile(self.latencies, 0.95), 2),
+            "e2e_p99_s": round(percentile(self.latencies, 0.99), 2),
+            "peak_heap_mb": round(peak / 1024 / 1024, 1),
+            "peak_threads": self.peak_threads,
+            "errors": dict(self.errors.most_common(5)),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end-to-end load benchmark against a stub midjourney-proxy")
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--requests", type=int, default=5, help="requests per user")
+    parser.add_argument("--render-delay", type=float, default=2.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--send-delay", type=float, default=0.05, help="simulated channel send seconds")
+    parser.add_argument("--mix", default='{"imagine": 0.7, "change": 0.2, "blend": 0.1}')
+    parser.add_argument("--config", default="{}", help="JSON overrides for the plugin config")
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    process, url = stub_proxy.spawn(render_delay=args.render_delay, fail_rate=args.fail_rate)
+    workdir = tempfile.mkdtemp(prefix="mj_bench_")
+    results = []
+    try:
+        for users in args.users:
+            channel = FakeChannel(send_delay=args.send_delay)
+            plugin = create_plugin(url, "%s/%d" % (workdir, users), channel, json.loads(args.config))
+            result = LoadRun(plugin, channel, users, args.requests, json.loads(args.mix), workdir,
+                             args.timeout).run()
+            print(json.dumps(result, ensure_ascii=False), flush=True)
+            results.append(result)
+    finally:
+        process.terminate()
+
+    columns = ["users", "requests", "ok", "error", "timeout", "rps", "handler_occupancy", "handler_p99_ms",
+               "e2e_p50_s", "e2e_p95_s", "e2e_p99_s", "peak_heap_mb", "peak_threads"]
+    print("\n" + " ".join("%12s" % column[:12] for column in columns))
+    for result in results:
+        print(" ".join("%12s" % result[column] for column in columns))
+
+
+if __name__ == "__main__":
+    main()
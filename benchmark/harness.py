@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+"""
+性能测试的公共组件：模拟的消息通道、合成的事件上下文，以及连接到模拟代理的插件实例
+
+需要在chatgpt-on-wechat项目主目录下运行，插件使用独立的配置和数据目录，不影响正式的数据库
+"""
+import json
+import os
+import queue
+import re
+import threading
+import time
+
+from PIL import Image
+
+from bridge.context import Context, ContextType
+from bridge.reply import ReplyType
+from plugins import Event, EventContext
+
+# 任务提交、排队等过程通知的开头，其余文本消息视为请求的最终结果
+NOTICE_PREFIXES = ("☑️", "🕒")
+TASK_ID_PATTERN = re.compile(r"ID：(\d+)")
+# 完成提示中的任务ID，用于后续的变换请求
+RESULT_ID_PATTERN = re.compile(r"(\d{12,})")
+
+
+class FakeMessage:
+    # 模拟的聊天消息，图片消息的prepare不需要下载
+    def __init__(self, nickname="bench"):
+        self.actual_user_nickname = nickname
+
+    def prepare(self):
+        pass
+
+
+class FakeChannel:
+    # 模拟的消息通道，记录每个会话收到的消息，send_delay为模拟的发送耗时
+    def __init__(self, send_delay=0.0):
+        self.send_delay = send_delay
+        self.lock = threading.Lock()
+        self.inboxes = {}
+        self.images = {}  # 会话ID -> 已收到图片、尚未收到完成提示
+        self.finished = {}  # 会话ID -> 最近完成的任务ID
+        self.sent = 0
+        self.last_send = time.time()
+
+    def inbox(self, session_id):
+        with self.lock:
+            if session_id not in self.inboxes:
+                self.inboxes[session_id] = queue.Queue()
+            return self.inboxes[session_id]
+
+    def send(self, reply, context):
+        if self.send_delay:
+            time.sleep(self.send_delay)
+        session_id = context["session_id"]
+        with self.lock:
+            self.sent += 1
+            self.last_send = time.time()
+            if reply.type != ReplyType.TEXT:
+                self.images[session_id] = True
+            elif self.images.pop(session_id, False):
+                match = RESULT_ID_PATTERN.search(str(reply.content))
+                if match:
+                    self.finished[session_id] = match.group(1)
+        self.inbox(session_id).put((time.time(), reply))
+
+    # 等待会话的最终结果，返回(是否收到图片, 最终文本, 任务ID)，超时返回None
+    def wait_result(self, session_id, timeout):
+        inbox = self.inbox(session_id)
+        deadline = time.time() + timeout
+        got_image = False
+        task_id = None
+        while True:
+            try:
+                _, reply = inbox.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                return None
+            if reply.type != ReplyType.TEXT:
+                got_image = True
+                continue
+            content = re.sub(r"^@.*\n", "", str(reply.content))
+            if content.startswith(NOTICE_PREFIXES):
+                match = TASK_ID_PATTERN.search(content)
+                task_id = match.group(1) if match else task_id
+                continue
+            return got_image, content, task_id
+
+
+# 合成一个事件上下文
+def make_context(content, session_id, context_type=ContextType.IMAGE_CREATE, group=False, nickname="bench"):
+    kwargs = {"session_id": session_id, "isgroup": group, "msg": FakeMessage(nickname), "receiver": session_id}
+    return EventContext(Event.ON_HANDLE_CONTEXT, {"context": Context(context_type, content, kwargs), "reply": None})
+
+
+# 生成合图、垫图使用的测试图片
+def make_image(directory, size=768, name="bench.jpg", color=(120, 160, 90), height=None):
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        Image.new("RGB", (size, height or size * 3 // 4), color).save(path, quality=90)
+    return path
+
+
+# 创建连接到模拟代理的插件实例，数据库和暂存文件保存在workdir下，overrides覆盖默认配置
+def create_plugin(stub_url, workdir, channel, overrides=None):
+    from plugins.midjourney_turbo.midjourney_turbo import MidjourneyTurbo
+
+    curdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(curdir, "config.json.template"), "r", encoding="utf-8") as f:
+        config = json.load(f)
+    config.update(domain_name=stub_url, data_dir=workdir, lock=False, gpt_optimized=False, short_url_api="",
+                  notify_hook="", poll_interval=1, poll_min_interval=0.5)
+    config.update(overrides or {})
+    os.makedirs(workdir, exist_ok=True)
+    config_path = os.path.join(workdir, "config.json")
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False)
+    os.environ["MIDJOURNEY_TURBO_CONFIG"] = config_path
+    try:
+        plugin = MidjourneyTurbo()
+    finally:
+        del os.environ["MIDJOURNEY_TURBO_CONFIG"]
+    plugin.comapp = channel
+    return plugin
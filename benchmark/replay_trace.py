@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+"""
+回放请求轨迹：按记录的到达间隔（可加速）把请求发送给连接到模拟代理的插件，检查调度、缓存等改动在真实流量下的表现
+
+轨迹由配置项trace_file开启记录，只包含请求分类、提示词长度、图片尺寸和到达间隔，回放时按这些信息合成请求内容。
+同一用户的请求按顺序处理，不同用户共享handler-threads个处理线程。在chatgpt-on-wechat项目主目录下运行：
+    python -m plugins.midjourney_turbo.benchmark.replay_trace --trace midjourney_trace.jsonl --speed 10
+"""
+import argparse
+import json
+import queue
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from bridge.context import ContextType
+from plugins.midjourney_turbo.benchmark import stub_proxy
+from plugins.midjourney_turbo.benchmark.harness import FakeChannel, create_plugin, make_context, make_image
+from plugins.midjourney_turbo.benchmark.bench_load import percentile
+from plugins.midjourney_turbo.lib import trace_recorder
+from plugins.midjourney_turbo.lib.trace_recorder import load_trace
+
+WORDS = ["cat", "garden", "neon", "city", "portrait", "watercolor", "sunset", "robot", "forest", "castle"]
+
+
+class Replay:
+    def __init__(self, plugin, channel, entries, speed, handler_threads, workdir, seed=0):
+        self.plugin = plugin
+        self.channel = channel
+        self.entries = entries
+        self.speed = speed
+        self.workdir = workdir
+        self.random = random.Random(seed)
+        self.slots = threading.Semaphore(handler_threads)
+        self.handler_threads = handler_threads
+        self.lock = threading.Lock()
+        self.queues = {}  # 用户序号 -> 待处理的请求
+        self.workers = []
+        self.handler_times = []
+        self.lags = []
+        self.counters = Counter()
+
+    # 按提示词长度合成提示词
+    def prompt(self, length):
+        words = []
+        while len(" ".join(words)) < max(1, length):
+            words.append(self.random.choice(WORDS))
+        return " ".join(words)[:max(1, length)]
+
+    # 根据轨迹中的请求合成事件上下文，无法合成（如变换时还没有完成的任务）时返回None
+    def build(self, entry, session_id):
+        cmd = entry["cmd"]
+        group = bool(entry.get("group"))
+        if cmd == trace_recorder.IMAGE:
+            color = tuple(self.random.randrange(256) for _ in range(3))
+            width = entry.get("w") or 768
+            path = make_image(self.workdir, width, "replay_%d_%d_%d.jpg" % color, color, entry.get("h") or width)
+            return make_context(path, session_id, ContextType.IMAGE, group=group)
+        if cmd in (trace_recorder.CHANGE, trace_recorder.REDELIVER):
+            task_id = self.channel.finished.get(session_id)
+            if task_id is None:
+                return None
+            content = "%s %s %s" % (self.plugin.change_ins, task_id, entry.get("btn", "")) \
+                if cmd == trace_recorder.CHANGE else "%s %s" % (self.plugin.change_ins, task_id)
+        elif cmd == trace_recorder.BLEND:
+            content = "%s %d" % (self.plugin.blend_ins, entry.get("n") or 2)
+        elif cmd == trace_recorder.IMAGE_PROMPT:
+            content = "%s %s" % (self.plugin.image_ins, self.prompt(entry.get("len", 20)))
+        elif cmd == trace_recorder.STATS:
+            content = self.plugin.stats_ins
+        else:
+            content = self.prompt(entry.get("len", 20))
+        return make_context(content.strip(), session_id, group=group)
+
+    # 每个用户一个线程，按到达顺序处理该用户的请求
+    def worker(self, user_queue, session_id):
+        while True:
+            entry = user_queue.get()
+            if entry is None:
+                return
+            e_context = self.build(entry, session_id)
+            if e_context is None:
+                with self.lock:
+                    self.counters["skipped"] += 1
+                continue
+            with self.slots:
+                start = time.perf_counter()
+                self.plugin.on_handle_context(e_context)
+                elapsed = time.perf_counter() - start
+            with self.lock:
+                self.handler_times.append(elapsed)
+                self.counters[entry["cmd"]] += 1
+
+    def dispatch(self, entry):
+        user = entry.get("user", 0)
+        if user not in self.queues:
+            self.queues[user] = queue.Queue()
+            thread = threading.Thread(target=self.worker, args=(self.queues[user], "replay_user_%d" % user),
+                                      daemon=True)
+            thread.start()
+            self.workers.append(thread)
+        self.queues[user].put(entry)
+
+    # 等待调度队列和进行中的任务全部结束
+    def drain(self, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            stats = self.plugin.scheduler.stats()
+            if stats["queued_now"] == 0 and sum(stats["in_flight"].values()) == 0:
+                return True
+            time.sleep(0.5)
+        return False
+
+    def run(self, timeout):
+        start = time.time()
+        for entry in self.entries:
+            due = start + entry["offset"] / self.speed
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.lags.append(max(0.0, time.time() - due))
+            self.dispatch(entry)
+        for user_queue in self.queues.values():
+            user_queue.put(None)
+        for thread in self.workers:
+            thread.join()
+        dispatched = time.time() - start
+        drained = self.drain(timeout)
+        wall = time.time() - start
+        return {
+            "requests": len(self.entries),
+            "speed": self.speed,
+            "users": len(self.queues),
+            "dispatch_s": round(dispatched, 2),
+            "wall_s": round(wall, 2),
+            "drained": drained,
+            "handler_p50_ms": round(percentile(self.handler_times, 0.5) * 1000, 1),
+            "handler_p99_ms": round(percentile(self.handler_times, 0.99) * 1000, 1),
+            # 处理线程占用率：所有处理函数的耗时之和 / (回放时长 * 处理线程数)
+            "handler_occupancy": round(sum(self.handler_times) / (dispatched * self.handler_threads), 4),
+            "schedule_lag_p99_s": round(percentile(self.lags, 0.99), 3),
+            "messages_sent": self.channel.sent,
+            "counts": dict(self.counters),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay a recorded request trace against a stub midjourney-proxy")
+    parser.add_argument("--trace", required=True)
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 10 means 10x faster")
+    parser.add_argument("--handler-threads", type=int, default=8, help="handler threads of the host channel")
+    parser.add_argument("--render-delay", type=float, default=5.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--send-delay", type=float, default=0.05, help="simulated channel send seconds")
+    parser.add_argument("--config", default="{}", help="JSON overrides for the plugin config")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for tasks after the replay")
+    args = parser.parse_args()
+
+    entries = load_trace(args.trace)
+    process, url = stub_proxy.spawn(render_delay=args.render_delay, fail_rate=args.fail_rate)
+    workdir = tempfile.mkdtemp(prefix="mj_replay_")
+    try:
+        channel = FakeChannel(send_delay=args.send_delay)
+        plugin = create_plugin(url, workdir, channel, json.loads(args.config))
+        result = Replay(plugin, channel, entries, args.speed, args.handler_threads, workdir).run(args.timeout)
+        print(json.dumps(result, ensure_ascii=False))
+        print(plugin.metrics.render_text())
+    finally:
+        process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+"""
+使用次数限制的并发压力测试
+
+在chatgpt-on-wechat项目主目录下运行：
+    python -m plugins.midjourney_turbo.benchmark.stress_usage_limiter --threads 32 --users 20 --calls 50
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from plugins.midjourney_turbo.lib.usage_limiter import UsageLimiter
+
+
+# 多个线程同时为同一批用户扣减次数，统计每个用户实际放行的次数
+def run(write_behind, threads, users, calls, trial_lock):
+    db_path = os.path.join(tempfile.mkdtemp(), "user.db")
+    limiter = UsageLimiter(db_path=db_path, trial_lock=trial_lock, write_behind=write_behind)
+    granted = Counter()
+    granted_lock = threading.Lock()
+    barrier = threading.Barrier(threads)
+
+    def worker(index):
+        barrier.wait()
+        for i in range(calls):
+            user_id = "user_%d" % ((index + i) % users)
+            allowed, _, _ = limiter.check_and_update(user_id)
+            if allowed:
+                with granted_lock:
+                    granted[user_id] += 1
+
+    start = time.time()
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.time() - start
+    if write_behind:
+        limiter.flush()
+
+    # 每个用户放行的次数必须正好等于试用次数，数据库中剩余次数必须为0
+    rows = dict(sqlite3.connect(db_path).execute("SELECT UserID, TrialCount FROM midjourneyturbo").fetchall())
+    over = {user_id: n for user_id, n in granted.items() if n != trial_lock}
+    left = {user_id: n for user_id, n in rows.items() if n != 0}
+    mode = "write_behind" if write_behind else "upsert"
+    print("[%s] %d calls in %.2fs (%.0f calls/s), users=%d, granted=%d, mismatched=%d, db_left=%d" % (
+        mode, threads * calls, elapsed, threads * calls / elapsed, len(granted), sum(granted.values()),
+        len(over), len(left)))
+    return not over and not left and len(granted) == users
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UsageLimiter concurrency stress test")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--calls", type=int, default=50)
+    parser.add_argument("--trial-lock", type=int, default=3)
+    args = parser.parse_args()
+
+    ok = True
+    for write_behind in (False, True):
+        ok = run(write_behind, args.threads, args.users, args.calls, args.trial_lock) and ok
+    print("PASS" if ok else "FAIL")
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
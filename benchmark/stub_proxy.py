@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+"""
+本地模拟的midjourney-proxy，用于性能测试，不依赖Discord
+
+单独运行：
+    python -m plugins.midjourney_turbo.benchmark.stub_proxy --port 8081 --render-delay 5
+"""
+import argparse
+import io
+import json
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+# 超过该大小的请求体只计数不解析，避免模拟代理本身占用大量内存
+MAX_PARSED_BODY = 1024 * 1024
+
+
+class StubProxy:
+    # 初始化函数，render_delay为模拟的出图秒数，image_size为返回图片的边长，fail_rate为接口返回500的概率
+    def __init__(self, host="127.0.0.1", port=0, render_delay=5.0, image_size=1024, fail_rate=0.0):
+        self.render_delay = render_delay
+        self.fail_rate = fail_rate
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.counters = {"submit": 0, "fetch": 0, "list": 0, "image": 0, "body_bytes": 0, "failed": 0}
+        image = Image.new("RGB", (image_size, image_size), (90, 120, 200))
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+        self.image = buffer.getvalue()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server.server_address
+
+    # 在后台线程中启动模拟代理
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="stub_proxy", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # 创建一个模拟任务
+    def submit(self, action, body):
+        task_id = str(uuid.uuid4().int)[:16]
+        now = int(time.time() * 1000)
+        with self.lock:
+            self.counters["submit"] += 1
+            self.tasks[task_id] = {"id": task_id, "action": action, "status": "SUBMITTED", "progress": "0%",
+                                   "submitTime": now, "startTime": now, "finishTime": None, "imageUrl": None,
+                                   "failReason": None, "prompt": body.get("prompt", "")}
+        return task_id
+
+    # 根据当前时间计算任务状态
+    def view(self, task_id):
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None:
+                return None
+            task = dict(task)
+        elapsed = time.time() * 1000 - task["submitTime"]
+        if elapsed >= self.render_delay * 1000:
+            task.update(status="SUCCESS", progress="100%", finishTime=task["submitTime"] + int(self.render_delay * 1000),
+                        imageUrl="%s/image/%s.png" % (self.url, task_id))
+        elif elapsed > 0:
+            progress = int(elapsed * 100 / (self.render_delay * 1000))
+            task.update(status="IN_PROGRESS", progress="%d%%" % progress)
+            # 与midjourney-proxy一样，出图过程中返回中间预览图
+            if progress >= 20:
+                task.update(imageUrl="%s/image/%s.png?progress=%d" % (self.url, task_id, progress))
+        return task
+
+    def _handler_class(self):
+        stub = self
+
+        class StubHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self._read_body()
+                if self._should_fail():
+                    return self._json({"error": "injected failure"}, 500)
+                match = re.match(r"^/mj/submit/(imagine|simple-change|blend)$", self.path)
+                if match:
+                    action = {"imagine": "IMAGINE", "simple-change": "CHANGE", "blend": "BLEND"}[match.group(1)]
+                    task_id = stub.submit(action, body)
+                    self._json({"code": 1, "description": "提交成功", "result": task_id})
+                elif self.path == "/mj/task/list-by-condition":
+                    with stub.lock:
+                        stub.counters["list"] += 1
+                    tasks = [stub.view(task_id) for task_id in body.get("ids", [])]
+                    self._json([task for task in tasks if task is not None])
+                else:
+                    self._json({"error": "not found"}, 404)
+
+            def do_GET(self):
+                match = re.match(r"^/mj/task/(\w+)/fetch$", self.path)
+                if match and self._should_fail():
+                    self._json({"error": "injected failure"}, 500)
+                elif match:
+                    with stub.lock:
+                        stub.counters["fetch"] += 1
+                    task = stub.view(match.group(1))
+                    self._json(task if task is not None else {"error": "not found"}, 200 if task else 404)
+                elif self.path.startswith("/image/"):
+                    with stub.lock:
+                        stub.counters["image"] += 1
+                    self._send(200, "image/png", stub.image)
+                else:
+                    self._json({"error": "not found"}, 404)
+
+            # 按fail_rate模拟代理故障
+            def _should_fail(self):
+                if stub.fail_rate and random.random() < stub.fail_rate:
+                    with stub.lock:
+                        stub.counters["failed"] += 1
+                    return True
+                return False
+
+            # 分块读取请求体，支持Content-Length和chunked两种方式
+            def _read_body(self):
+                chunks = []
+                total = 0
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    while True:
+                        size = int(self.rfile.readline().split(b";")[0], 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            break
+                        total += self._consume(size, chunks, total)
+                        self.rfile.readline()
+                else:
+                    length = int(self.headers.get("Content-Length", 0))
+                    self._consume(length, chunks, 0)
+                    total = length
+                with stub.lock:
+                    stub.counters["body_bytes"] += total
+                if total > MAX_PARSED_BODY or not chunks:
+                    return {}
+                try:
+                    return json.loads(b"".join(chunks).decode("utf-8"))
+                except ValueError:
+                    return {}
+
+            def _consume(self, size, chunks, already):
+                remaining = size
+                while remaining:
+                    data = self.rfile.read(min(remaining, 64 * 1024))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    if already + size <= MAX_PARSED_BODY:
+                        chunks.append(data)
+                return size
+
+            def _json(self, obj, code=200):
+                self._send(code, "application/json", json.dumps(obj).encode("utf-8"))
+
+            def _send(self, code, content_type, data):
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return StubHandler
+
+
+# 在子进程中启动模拟代理，避免代理本身的内存和线程计入测量结果，返回(进程, 地址)
+def spawn(render_delay=5.0, fail_rate=0.0):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen([sys.executable, "-m", "plugins.midjourney_turbo.benchmark.stub_proxy",
+                                "--port", str(port), "--render-delay", str(render_delay),
+                                "--fail-rate", str(fail_rate)], stdout=subprocess.PIPE)
+    process.stdout.readline()
+    return process, "http://127.0.0.1:%d" % port
+
+
+def main():
+    parser = argparse.ArgumentParser(description="stand-in midjourney-proxy")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--render-delay", type=float, default=5.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    stub = StubProxy(host=args.host, port=args.port, render_delay=args.render_delay, fail_rate=args.fail_rate)
+    print("stub proxy listening on %s" % stub.url, flush=True)
+    stub.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import threading
+import time
+from collections import deque
+
+from common.log import logger
+from plugins.midjourney_turbo.lib.midJourney_module import MidJourneyModule, is_task_finished
+from plugins.midjourney_turbo.lib.resilience import CIRCUIT_OPEN, ProxyError
+
+
+# 解析domain_name配置，支持单个域名字符串，或由域名字符串/字典组成的列表
+def parse_backends(domain_name, api_key="", max_in_flight=3):
+    """
+    解析后端配置
+
+    参数:
+        domain_name (str | list): 单个域名，或列表，列表元素为域名字符串或
+                                  {"name": 名称, "domain_name": 域名, "api_key": 密钥, "weight": 权重,
+                                   "max_in_flight": 该代理的并发数}
+        api_key (str): 列表元素未配置api_key时使用的默认密钥
+        max_in_flight (int): 列表元素未配置max_in_flight时使用的并发数
+
+    返回:
+        [{"name", "domain_name", "api_key", "weight", "max_in_flight"}]
+    """
+    items = domain_name if isinstance(domain_name, list) else [domain_name]
+    backends = []
+    for item in items:
+        if isinstance(item, str):
+            item = {"domain_name": item}
+        domain = item.get("domain_name", "").rstrip("/")
+        if not domain or "你的域名" in domain:
+            continue
+        backends.append({"name": item.get("name") or domain, "domain_name": domain,
+                         "api_key": item.get("api_key", api_key), "weight": max(float(item.get("weight", 1)), 0.01),
+                         "max_in_flight": max(int(item.get("max_in_flight", max_in_flight)), 1)})
+    return backends
+
+
+class Backend:
+    # 单个midjourney-proxy后端，记录进行中的任务数和最近的请求结果，max_in_flight为该代理的并发数
+    def __init__(self, name, mm, weight=1, window=20, max_in_flight=3):
+        self.name = name
+        self.mm = mm
+        self.weight = weight
+        self.max_in_flight = max_in_flight
+        self.outstanding = 0
+        self.results = deque(maxlen=window)
+        self.probe_ok = True
+
+    def error_rate(self):
+        return self.results.count(False) / len(self.results) if self.results else 0.0
+
+
+class BackendPool:
+    # 初始化函数，backends为parse_backends的结果，module_options为创建MidJourneyModule的其余参数
+    # owner_lookup为根据任务ID查找所属后端名称的函数（可选），用于重启后仍能把变换任务发到原后端
+    def __init__(self, backends, owner_lookup=None, probe_interval=30, max_error_rate=0.5, min_samples=5,
+                 **module_options):
+        assert backends, "BackendPool needs at least one backend."
+        self.backends = [Backend(b["name"], MidJourneyModule(api_key=b["api_key"], domain_name=b["domain_name"],
+                                                             **module_options), weight=b["weight"],
+                                 max_in_flight=b.get("max_in_flight", 3))
+                         for b in backends]
+        self.by_name = {backend.name: backend for backend in self.backends}
+        self.owner_lookup = owner_lookup
+        self.probe_interval = probe_interval
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.owners = {}  # task_id -> Backend，只保存进行中的任务
+        # 只有一个后端时不需要探测和选择
+        if len(self.backends) > 1 and probe_interval:
+            threading.Thread(target=self._probe_loop, name="mj_probe", daemon=True).start()
+
+    # 提交出图或垫图任务，发送到负载最低的健康后端
+    def get_imagine(self, prompt, base64_data=None):
+        return self._submit_new(lambda mm: mm.get_imagine(prompt=prompt, base64_data=base64_data))
+
+    # 提交混合任务，发送到负载最低的健康后端
+    def submit_blend(self, base64_data, dimensions="SQUARE"):
+        return self._submit_new(lambda mm: mm.submit_blend(base64_data, dimensions=dimensions))
+
+    # 提交变换任务，发送到原任务所在的后端，找不到时使用第一个后端
+    def get_simple(self, content):
+        backend = self.owner(content.split()[0]) or self.backends[0]
+        return self._submit(backend, backend.mm.get_simple(content=content))
+
+    # 批量查询任务，按所属后端分组查询后合并结果，部分后端失败时返回其余后端的结果
+    def list_by_condition(self, ids):
+        groups = {}
+        for task_id in ids:
+            backend = self.owner(task_id)
+            for target in ([backend] if backend else self.backends):
+                groups.setdefault(target.name, []).append(task_id)
+
+        merged = []
+        error = None
+        failed = 0
+        for name, group in groups.items():
+            backend = self.by_name[name]
+            list_data = backend.mm.list_by_condition(group)
+            self._record(backend, list_data)
+            if isinstance(list_data, ProxyError):
+                error = list_data
+                failed += 1
+                continue
+            for task_data in list_data:
+                if is_task_finished(task_data):
+                    self.release(task_data["id"])
+                merged.append(task_data)
+        if groups and failed == len(groups):
+            return error
+        return merged
+
+    # 任务结束后减少所属后端的进行中任务数，重复调用不会重复减少
+    def release(self, task_id):
+        with self.lock:
+            backend = self.owners.pop(task_id, None)
+            if backend is not None:
+                backend.outstanding -= 1
+
+    # 查找任务所属的后端
+    def owner(self, task_id):
+        with self.lock:
+            backend = self.owners.get(task_id)
+        if backend is None and self.owner_lookup is not None:
+            backend = self.by_name.get(self.owner_lookup(task_id))
+        return backend
+
+    # 所有后端的并发数之和，作为本地提交调度的名额上限
+    def capacity(self):
+        return sum(backend.max_in_flight for backend in self.backends)
+
+    # 获取统计信息
+    def stats(self):
+        with self.lock:
+            return {backend.name: {"outstanding": backend.outstanding, "healthy": self._healthy(backend),
+                                   "error_rate": round(backend.error_rate(), 2),
+                                   "breakers": {action: breaker.state() for action, breaker in
+                                                backend.mm.breakers.items()}} for backend in self.backends}
+
+    # 选择进行中任务数与权重之比最小的健康后端，优先选择并发未满的后端，全部不健康时在所有后端中选择
+    def _choose(self, exclude=()):
+        with self.lock:
+            backends = [backend for backend in self.backends if backend not in exclude]
+            healthy = [backend for backend in backends if self._healthy(backend)]
+            candidates = [backend for backend in healthy if backend.outstanding < backend.max_in_flight] \
+                or healthy or backends
+            return min(candidates, key=lambda backend: (backend.outstanding + 1) / backend.weight)
+
+    def _healthy(self, backend):
+        if not backend.probe_ok or backend.mm.breakers["imagine"].state() == "open":
+            return False
+        return len(backend.results) < self.min_samples or backend.error_rate() <= self.max_error_rate
+
+    # 提交新任务，后端熔断时请求没有发出，可以安全地换下一个后端
+    def _submit_new(self, submit):
+        tried = []
+        for _ in self.backends:
+            backend = self._choose(exclude=tried)
+            tried.append(backend)
+            submit_data = self._submit(backend, submit(backend.mm))
+            if not isinstance(submit_data, ProxyError) or submit_data.kind != CIRCUIT_OPEN:
+                break
+        return submit_data
+
+    def _submit(self, backend, submit_data):
+        self._record(backend, submit_data)
+        if not isinstance(submit_data, ProxyError):
+            with self.lock:
+                self.owners[submit_data["result"]] = backend
+                backend.outstanding += 1
+            submit_data["backend"] = backend.name
+        return submit_data
+
+    # 记录请求结果，代理返回的业务错误（如提示词违规）和熔断中的快速失败不计入后端的错误率
+    def _record(self, backend, result):
+        if isinstance(result, ProxyError) and not result.transient:
+            return
+        with self.lock:
+            backend.results.append(not isinstance(result, ProxyError))
+
+    # 定期探测所有后端，探测成功后清空错误记录，重新参与选择
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.probe_interval)
+            for backend in self.backends:
+                ok = not isinstance(backend.mm.list_by_condition([]), ProxyError)
+                with self.lock:
+                    if ok and not self._healthy(backend):
+                        logger.info("[BackendPool] backend %s recovered" % backend.name)
+                        backend.results.clear()
+                    elif not ok and backend.probe_ok:
+                        logger.warn("[BackendPool] backend %s probe failed" % backend.name)
+                    backend.probe_ok = ok
@@ -0,0 +1,45 @@
+import importlib
+import threading
+
+from bridge.reply import ReplyType
+
+# 频道类型 -> (模块, 类名, 图片回复类型, 图片发送方式)，图片发送方式为1时下载压缩后发送图片，为2时发送图片链接
+CHANNELS = {
+    "wechat": ("channel.wechat.wechat_channel", "WechatChannel", ReplyType.IMAGE, 1),
+    "wx": ("channel.wechat.wechat_channel", "WechatChannel", ReplyType.IMAGE, 1),
+    "wxy": ("channel.wechat.wechat_channel", "WechatChannel", ReplyType.IMAGE, 1),
+    "wechatmp": ("channel.wechatmp.wechatmp_channel", "WechatMPChannel", ReplyType.IMAGE_URL, 2),
+    "wechatmp_service": ("channel.wechatmp.wechatmp_channel", "WechatMPChannel", ReplyType.IMAGE_URL, 2),
+    "wechatcom_app": ("channel.wechatcom.wechatcomapp_channel", "WechatComAppChannel", ReplyType.IMAGE_URL, 2),
+    "wework": ("channel.wework.wework_channel", "WeworkChannel", ReplyType.IMAGE_URL, 2),
+    "weworktop": ("channel.weworktop.weworktop_channel", "WeworkChannel", ReplyType.IMAGE_URL, 2),
+    "ntchat": ("channel.wechatnt.ntchat_channel", "NtchatChannel", ReplyType.IMAGE_URL, 2),
+}
+DEFAULT_CHANNEL = "wechat"
+
+
+class LazyChannel:
+    # 频道对象的代理，第一次发送消息时才导入对应的频道模块并创建频道对象
+    def __init__(self, module, class_name):
+        self.module = module
+        self.class_name = class_name
+        self.lock = threading.Lock()
+        self.instance = None
+
+    # 获取频道对象，只导入当前使用的频道模块
+    def get(self):
+        if self.instance is None:
+            with self.lock:
+                if self.instance is None:
+                    channel_class = getattr(importlib.import_module(self.module), self.class_name)
+                    self.instance = channel_class()
+        return self.instance
+
+    def send(self, reply, context):
+        return self.get().send(reply, context)
+
+
+# 根据频道类型获取(频道对象, 图片回复类型, 图片发送方式)，未知的频道类型按个人微信处理
+def resolve_channel(channel_type):
+    module, class_name, reply_type, num = CHANNELS.get(channel_type, CHANNELS[DEFAULT_CHANNEL])
+    return LazyChannel(module, class_name), reply_type, num
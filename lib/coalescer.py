@@ -0,0 +1,70 @@
+import hashlib
+import threading
+import time
+
+
+# 计算文件内容的摘要，作为合并键的一部分
+def file_digest(path, chunk_size=64 * 1024):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Coalescer:
+    # 初始化函数，window为相同任务可以合并的秒数，0为不合并
+    def __init__(self, window=60):
+        self.window = window
+        self.lock = threading.Lock()
+        self.flights = {}  # key -> {"created": float, "task_id": str, "users": set, "subscribers": list}
+        self.counters = {"leaders": 0, "joined": 0, "duplicates": 0}
+
+    # 加入相同的进行中任务，没有可合并的任务时成为发起者
+    def join(self, key, user_id, subscriber):
+        """
+        加入相同的进行中任务
+
+        参数:
+            key (str): 合并键，由最终提示词和图片摘要组成
+            user_id (str): 会话ID，同一会话重复发送的任务不会重复接收结果
+            subscriber: 任务结束时接收结果的对象
+
+        返回:
+            (任务记录, 角色)，角色为leader（发起者）、joined（已合并）或duplicate（同一会话重复发送）
+        """
+        now = time.time()
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None and now - flight["created"] <= self.window:
+                if user_id in flight["users"]:
+                    self.counters["duplicates"] += 1
+                    return flight, "duplicate"
+                flight["users"].add(user_id)
+                flight["subscribers"].append(subscriber)
+                self.counters["joined"] += 1
+                return flight, "joined"
+            # 超出合并时间的旧任务继续执行，但不再接收新的合并请求
+            flight = {"key": key, "created": now, "task_id": None, "users": {user_id}, "subscribers": [subscriber]}
+            self.flights[key] = flight
+            self.counters["leaders"] += 1
+            return flight, "leader"
+
+    # 任务提交成功后记录任务ID，返回当前所有接收者
+    def submitted(self, flight, task_id):
+        with self.lock:
+            flight["task_id"] = task_id
+            return list(flight["subscribers"])
+
+    # 任务结束后移除记录，返回所有接收者
+    def finish(self, flight):
+        with self.lock:
+            if self.flights.get(flight["key"]) is flight:
+                del self.flights[flight["key"]]
+            return list(flight["subscribers"])
+
+    # 获取统计信息，saved为节省的任务数
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, saved=self.counters["joined"] + self.counters["duplicates"],
+                        in_flight=len(self.flights))
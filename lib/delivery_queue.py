@@ -0,0 +1,150 @@
+import json
+import queue
+import threading
+import time
+from collections import deque
+
+from common.log import logger
+from plugins.midjourney_turbo.lib.resilience import backoff_delay
+
+# 这些异常说明消息本身有问题，重试也不会成功
+PERMANENT_ERRORS = (TypeError, ValueError, KeyError, AttributeError)
+
+
+class DeliveryQueue:
+    # 后台发送消息的队列，同一会话的消息按入队顺序逐条发送，不同会话由workers个线程并行发送
+    # send为频道的发送函数，max_pending为排队消息数的上限，发送失败时退避重试，max_attempts次后写入dead_letter_path
+    def __init__(self, send, workers=4, max_pending=1000, max_attempts=4, base_delay=1, max_delay=30,
+                 dead_letter_path="", metrics=None):
+        self.send = send
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.dead_letter_path = dead_letter_path
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.conversations = {}  # 会话 -> deque[消息]，正在发送或等待重试的会话也在其中
+        self.ready = queue.Queue()  # 有待发送消息且没有线程处理的会话
+        self.pending = 0
+        self.dead_letters = deque(maxlen=20)
+        self.counters = {"enqueued": 0, "sent": 0, "retries": 0, "dead": 0, "rejected": 0, "peak_pending": 0}
+        for i in range(workers):
+            threading.Thread(target=self._worker, name="mj_delivery_%d" % i, daemon=True).start()
+
+    # 消息入队，立即返回；队列已满时写入死信记录并返回False
+    def enqueue(self, reply, context, label="text"):
+        """
+        消息入队
+
+        参数:
+            reply (Reply): 要发送的回复，图片内容为BytesIO时重试前会回到开头
+            context (Context): 消息上下文，按接收者区分会话
+            label (str): 消息类型，用于统计
+
+        返回:
+            bool: 是否成功入队
+        """
+        conversation = context.kwargs.get("receiver") or context.kwargs.get("session_id")
+        item = {"reply": reply, "context": context, "label": label, "attempts": 0, "enqueued": time.time()}
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.counters["rejected"] += 1
+                full = True
+            else:
+                full = False
+                self.pending += 1
+                self.counters["enqueued"] += 1
+                self.counters["peak_pending"] = max(self.counters["peak_pending"], self.pending)
+                items = self.conversations.get(conversation)
+                if items is None:
+                    items = self.conversations[conversation] = deque()
+                    self.ready.put(conversation)
+                items.append(item)
+        if full:
+            self._incr("delivery_rejected", label)
+            self._dead_letter(conversation, item, "delivery queue full")
+            return False
+        return True
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, pending=self.pending, conversations=len(self.conversations))
+
+    def _worker(self):
+        while True:
+            conversation = self.ready.get()
+            with self.lock:
+                item = self.conversations[conversation][0]
+            if self.metrics and item["attempts"] == 0:
+                self.metrics.observe("delivery_wait", time.time() - item["enqueued"], item["label"])
+            error = self._send(item)
+            if error is None:
+                self._incr("delivery_sent", item["label"])
+                self._next(conversation, "sent")
+                continue
+            item["attempts"] += 1
+            if isinstance(error, PERMANENT_ERRORS) or item["attempts"] >= self.max_attempts:
+                logger.error("[DeliveryQueue] giving up %s message to %s after %d attempts: %r" % (
+                    item["label"], conversation, item["attempts"], error))
+                self._incr("delivery_dead", item["label"])
+                self._dead_letter(conversation, item, repr(error))
+                self._next(conversation, "dead")
+                continue
+            # 退避后重新排队，等待期间该会话的后续消息不会发送，保证顺序
+            delay = min(self.max_delay, self.base_delay + backoff_delay(item["attempts"], self.base_delay,
+                                                                        self.max_delay))
+            logger.warn("[DeliveryQueue] send to %s failed (attempt %d), retry in %.1fs: %r" % (
+                conversation, item["attempts"], delay, error))
+            self._incr("delivery_retry", item["label"])
+            with self.lock:
+                self.counters["retries"] += 1
+            timer = threading.Timer(delay, self.ready.put, args=(conversation,))
+            timer.daemon = True
+            timer.start()
+
+    def _send(self, item):
+        content = item["reply"].content
+        if item["attempts"] and hasattr(content, "seek"):
+            content.seek(0)
+        start = time.perf_counter()
+        try:
+            self.send(item["reply"], item["context"])
+            return None
+        except Exception as e:
+            return e
+        finally:
+            if self.metrics:
+                self.metrics.observe("delivery_send", time.perf_counter() - start, item["label"])
+
+    # 移除已处理的消息，会话还有消息时重新排到队尾
+    def _next(self, conversation, outcome):
+        with self.lock:
+            items = self.conversations[conversation]
+            items.popleft()
+            self.pending -= 1
+            self.counters[outcome] += 1
+            if items:
+                self.ready.put(conversation)
+            else:
+                del self.conversations[conversation]
+
+    # 记录最终发送失败的消息，图片只记录大小
+    def _dead_letter(self, conversation, item, error):
+        content = item["reply"].content
+        if hasattr(content, "getbuffer"):
+            content = "<image %d bytes>" % content.getbuffer().nbytes
+        record = {"time": int(time.time()), "conversation": conversation, "type": str(item["reply"].type),
+                  "label": item["label"], "attempts": item["attempts"], "error": error, "content": str(content)[:500]}
+        self.dead_letters.append(record)
+        if not self.dead_letter_path:
+            return
+        try:
+            with self.lock, open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.error("[DeliveryQueue] failed to write dead letter: %s" % e)
+
+    def _incr(self, event, label):
+        if self.metrics:
+            self.metrics.incr(event, label)
@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+from collections import deque
+
+from common.log import logger
+
+
+class LatencyModel:
+    # 初始化函数，需要统计文件路径作为参数，每种任务类型最多保留max_samples个样本
+    def __init__(self, path, max_samples=200, min_samples=5, save_every=10):
+        self.path = path
+        self.max_samples = max_samples
+        self.min_samples = min_samples
+        self.save_every = save_every
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.unsaved = 0
+        self.load()
+
+    # 从统计文件加载历史样本
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            with self.lock:
+                for action, values in data.items():
+                    self.samples[action] = deque(values, maxlen=self.max_samples)
+            logger.info("[LatencyModel] loaded stats for %s" % list(data.keys()))
+        except Exception as e:
+            logger.warn("[LatencyModel] failed to load %s: %s" % (self.path, e))
+
+    # 将样本写入统计文件，先写临时文件再替换，避免写入中断损坏文件
+    def save(self):
+        with self.lock:
+            data = {action: list(values) for action, values in self.samples.items()}
+            self.unsaved = 0
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warn("[LatencyModel] failed to save %s: %s" % (self.path, e))
+
+    # 记录一个已完成任务的耗时（提交到完成）
+    def record(self, action, task_data):
+        """
+        记录一个已完成任务的耗时
+
+        参数:
+            action (str): 任务类型，如IMAGINE、UPSCALE、VARIATION、BLEND
+            task_data (dict): 任务结果数据，需要包含submitTime和finishTime
+        """
+        if task_data.get('submitTime') is None or task_data.get('finishTime') is None:
+            return
+        duration = (task_data['finishTime'] - task_data['submitTime']) / 1000
+        if duration <= 0:
+            return
+        with self.lock:
+            self.samples.setdefault(action, deque(maxlen=self.max_samples)).append(round(duration, 3))
+            self.unsaved += 1
+            need_save = self.unsaved >= self.save_every
+        if need_save:
+            self.save()
+
+    # 获取某种任务耗时的分位数，样本不足时返回None
+    def quantile(self, action, q):
+        with self.lock:
+            values = sorted(self.samples.get(action, ()))
+        if len(values) < self.min_samples:
+            return None
+        index = min(len(values) - 1, int(q * len(values)))
+        return values[index]
+
+    # 根据已等待时间计算下一次查询前需要等待的秒数
+    def next_delay(self, action, elapsed, min_interval, max_interval):
+        """
+        计算下一次查询前需要等待的秒数，预计完成时间附近密集查询，其余时间稀疏查询
+
+        参数:
+            action (str): 任务类型
+            elapsed (float): 任务提交后已经过的秒数
+            min_interval (float): 最短查询间隔
+            max_interval (float): 最长查询间隔，样本不足时使用该间隔
+
+        返回:
+            下一次查询前需要等待的秒数
+        """
+        p50 = self.quantile(action, 0.5)
+        p90 = self.quantile(action, 0.9)
+        if p50 is None:
+            return max_interval
+        if elapsed < p50 * 0.8:
+            # 距离预计完成时间还早，直接等到p50附近
+            return max(min_interval, min(p50 * 0.8 - elapsed, max_interval * 3))
+        if elapsed < p90:
+            # 处于大多数任务完成的区间，密集查询
+            return min_interval
+        # 超过p90的长尾任务，稀疏查询
+        return max_interval
+
+    # 根据p99获取某种任务的超时时间，样本不足时返回默认值
+    def timeout(self, action, default=300, factor=2, floor=120):
+        p99 = self.quantile(action, 0.99)
+        if p99 is None:
+            return default
+        return max(p99 * factor, floor)
@@ -0,0 +1,151 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from common.log import logger
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class RollingHistogram:
+    # 保留最近size个样本计算分位数，count和sum为启动以来的累计值
+    def __init__(self, size=1024):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self, qs=QUANTILES):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {q: None for q in qs}
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in qs}
+
+
+class Metrics:
+    # 按阶段和任务类型统计耗时，按事件和任务类型计数，window为每个直方图保留的样本数
+    def __init__(self, window=1024):
+        self.window = window
+        self.lock = threading.Lock()
+        self.histograms = {}  # (stage, action) -> RollingHistogram
+        self.counters = {}  # (event, action) -> int
+
+    # 记录一个阶段的耗时秒数
+    def observe(self, stage, seconds, action="all"):
+        with self.lock:
+            histogram = self.histograms.get((stage, action))
+            if histogram is None:
+                histogram = self.histograms[(stage, action)] = RollingHistogram(self.window)
+            histogram.observe(seconds)
+
+    # 事件计数
+    def incr(self, event, action="all", n=1):
+        with self.lock:
+            self.counters[(event, action)] = self.counters.get((event, action), 0) + n
+
+    # 统计代码块的耗时，异常时同样记录
+    @contextmanager
+    def timer(self, stage, action="all"):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, action)
+
+    # 获取当前统计结果
+    def snapshot(self):
+        with self.lock:
+            histograms = {key: (h.quantiles(), h.count, h.sum) for key, h in self.histograms.items()}
+            counters = dict(self.counters)
+        return histograms, counters
+
+    # 生成发送到聊天中的统计文本
+    def render_text(self):
+        histograms, counters = self.snapshot()
+        lines = ["📊阶段耗时（秒，p50/p95/p99，次数）"]
+        for (stage, action), (quantiles, count, _) in sorted(histograms.items()):
+            values = "/".join("-" if v is None else "%.2f" % v for v in quantiles.values())
+            lines.append("%s[%s]: %s, %d" % (stage, action, values, count))
+        lines.append("📈事件计数")
+        for (event, action), value in sorted(counters.items()):
+            lines.append("%s[%s]: %d" % (event, action, value))
+        return "\n".join(lines)
+
+    # 生成Prometheus文本格式
+    def render_prometheus(self, prefix="midjourney_turbo"):
+        histograms, counters = self.snapshot()
+        lines = ["# TYPE %s_stage_seconds summary" % prefix]
+        for (stage, action), (quantiles, count, total) in sorted(histograms.items()):
+            labels = 'stage="%s",action="%s"' % (stage, action)
+            for q, value in quantiles.items():
+                if value is not None:
+                    lines.append('%s_stage_seconds{%s,quantile="%s"} %.6f' % (prefix, labels, q, value))
+            lines.append("%s_stage_seconds_sum{%s} %.6f" % (prefix, labels, total))
+            lines.append("%s_stage_seconds_count{%s} %d" % (prefix, labels, count))
+        lines.append("# TYPE %s_events_total counter" % prefix)
+        for (event, action), value in sorted(counters.items()):
+            lines.append('%s_events_total{event="%s",action="%s"} %d' % (prefix, event, action, value))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    # 导出Prometheus指标，path为定期写入的文本文件（可配合node_exporter的textfile收集器），port为/metrics监听端口
+    def __init__(self, metrics, path="", port=0, host="0.0.0.0", interval=15):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.server = None
+        if port:
+            self.server = ThreadingHTTPServer((host, port), self._handler_class())
+            self.server.daemon_threads = True
+
+    def start(self):
+        if self.path:
+            threading.Thread(target=self._write_loop, name="mj_metrics", daemon=True).start()
+        if self.server is not None:
+            threading.Thread(target=self.server.serve_forever, name="mj_metrics_http", daemon=True).start()
+            logger.info("[MetricsExporter] listening on %s:%d/metrics" % self.server.server_address[:2])
+        return self
+
+    # 原子地写入文本文件，避免收集器读到写了一半的内容
+    def write(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.metrics.render_prometheus())
+        os.replace(tmp_path, self.path)
+
+    def _write_loop(self):
+        while True:
+            try:
+                self.write()
+            except Exception as e:
+                logger.error("[MetricsExporter] write %s failed: %s" % (self.path, e))
+            time.sleep(self.interval)
+
+    def _handler_class(self):
+        metrics = self.metrics
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                data = metrics.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return MetricsHandler
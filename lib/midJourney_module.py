@@ -1,91 +1,195 @@
+import base64
 import json
+import os
+import threading
 import time
 import requests
+from requests.adapters import HTTPAdapter
 
 from common.log import logger
+from plugins.midjourney_turbo.lib.resilience import CIRCUIT_OPEN, HTTP, NETWORK, REJECTED, TASK_TIMEOUT, TIMEOUT, \
+    CircuitBreaker, ProxyError, RetryBudget, backoff_delay
 
 
-class MidJourneyModule:
-    # 初始化函数，需要API密钥和域名作为参数
-    def __init__(self, api_key, domain_name):
-        self.api_key = api_key
-        self.domain_name = domain_name
+# 创建带连接池的HTTP会话，复用keep-alive连接，避免每次请求都重新握手
+def create_session(pool_size=20):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-    # 提交出图或垫图任务的函数
-    def get_imagine(self, prompt, base64_data=None):
+
+class ImageSource:
+    # 图片数据来源，path为本地文件路径，data为内存中的图片数据，二选一，mime为图片的MIME类型
+    def __init__(self, mime, path=None, data=None):
+        assert (path is None) != (data is None), "ImageSource needs exactly one of path or data."
+        self.mime = mime
+        self.path = path
+        self.data = data
+        self.prefix = f"data:{mime};base64,".encode("utf-8")
+
+    # 原始图片的字节数
+    def size(self):
+        return len(self.data) if self.data is not None else os.path.getsize(self.path)
+
+    # 编码为data URI后的字节数
+    def encoded_length(self):
+        return len(self.prefix) + (self.size() + 2) // 3 * 4
+
+    # 分块读取图片并逐块进行base64编码，每块读取的字节数是3的倍数，拼接结果与整体编码一致
+    def iter_base64(self, chunk_size=48 * 1024):
+        yield self.prefix
+        if self.data is not None:
+            view = memoryview(self.data)
+            for start in range(0, len(view), chunk_size):
+                yield base64.b64encode(view[start:start + chunk_size])
+            return
+        carry = b""
+        with open(self.path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                chunk = carry + chunk
+                cut = len(chunk) - len(chunk) % 3
+                carry = chunk[cut:]
+                yield base64.b64encode(chunk[:cut])
+        if carry:
+            yield base64.b64encode(carry)
+
+
+class JsonStreamBody:
+    # 流式JSON请求体，data为普通字段，key对应的值由图片来源逐块编码生成，sources为单个图片或图片列表
+    def __init__(self, data, key, sources):
         """
-        提交出图或垫图任务
+        构建流式JSON请求体，发送时逐块生成base64编码，不在内存中拼接完整的请求体
 
         参数:
-            prompt (str): 提示文本
-            base64_data (str): 图像的base64编码数据 (可选)
-
-        返回:
-            如果任务提交成功，则返回任务结果数据，否则返回错误描述
+            data (dict): 其余的普通字段
+            key (str): 图片字段名
+            sources: ImageSource或base64字符串，或由它们组成的列表
         """
-        data = {"base64": base64_data, "prompt": prompt}
-        api_url = f"{self.domain_name}/mj/submit/imagine"
+        head = json.dumps(data)[:-1]
+        head += (", " if data else "") + json.dumps(key) + ": "
+        items = sources if isinstance(sources, list) else [sources]
+        self.parts = [(head + ("[" if isinstance(sources, list) else "")).encode("utf-8")]
+        for index, item in enumerate(items):
+            if index:
+                self.parts.append(b", ")
+            if isinstance(item, ImageSource):
+                self.parts.extend([b'"', item, b'"'])
+            else:
+                self.parts.append(json.dumps(item).encode("utf-8"))
+        self.parts.append(("]" if isinstance(sources, list) else "").encode("utf-8") + b"}")
 
-        headers = {
-            "mj-api-secret": self.api_key
-        }
+    # 请求体的总字节数，用于设置Content-Length
+    def __len__(self):
+        return sum(part.encoded_length() if isinstance(part, ImageSource) else len(part) for part in self.parts)
 
-        # 发送POST请求
-        try:
-            response = requests.post(url=api_url, headers=headers, json=data, timeout=120.05)
-            if response.status_code == 200:
-                get_imagine_data = response.json()
-                logger.debug("get_imagine_data: %s" % get_imagine_data)
-                if get_imagine_data.get('code') != 1:
-                    return get_imagine_data.get('description')
-                else:
-                    return get_imagine_data
+    def __iter__(self):
+        for part in self.parts:
+            if isinstance(part, ImageSource):
+                yield from part.iter_base64()
             else:
-                logger.error("Error occurred: %s" % response.text)
-                return "哦豁，出现了未知错误，请联系管理员~~~"
-        except Exception as e:
-            logger.error("Error occurred: %s" % str(e))
-            return "哦豁，出现了未知错误，请联系管理员~~~"
+                yield part
+
 
-    # 查询任务获取进度的函数
-    def get_image_url(self, id):
+class MidJourneyModule:
+    # 初始化函数，需要API密钥和域名作为参数，notify_hook为任务状态回调地址（可选）
+    # session为共享的HTTP会话，timeout为（连接超时，读取超时）
+    # failure_threshold和reset_timeout为熔断参数，max_retries为查询接口失败时的最多重试次数
+    def __init__(self, api_key, domain_name, notify_hook="", session=None, timeout=(5, 120.05),
+                 failure_threshold=5, reset_timeout=30, max_retries=2):
+        self.api_key = api_key
+        self.domain_name = domain_name
+        self.notify_hook = notify_hook
+        self.session = session or create_session()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        # 请求头只构建一次，不放在会话上，避免密钥被发送到其他域名
+        self.headers = {"mj-api-secret": self.api_key}
+        self.json_headers = {"Content-Type": "application/json", "mj-api-secret": self.api_key}
+        # 每种接口一个熔断器，代理故障时直接返回错误，不再等待超时
+        self.breakers = {action: CircuitBreaker(f"{domain_name} {action}", failure_threshold, reset_timeout)
+                         for action in ("imagine", "change", "blend", "fetch")}
+        # 查询接口的重试预算，避免代理故障时重试请求成倍增加
+        self.retry_budget = RetryBudget()
+
+    # 发送请求并解析JSON，失败时返回ProxyError
+    def _request(self, action, method, url, retry=False, **kwargs):
         """
-        查询任务获取进度
+        发送请求并解析JSON
 
         参数:
-            id (str): 任务ID
+            action (str): 接口类型，对应熔断器
+            method (str): 请求方法
+            url (str): 请求地址
+            retry (bool): 是否允许重试，只用于查询等可以安全重复的请求
 
         返回:
-            如果任务成功完成，则返回任务结果数据，否则返回错误描述
+            成功时返回解析后的JSON，否则返回ProxyError
         """
-        api_url = f"{self.domain_name}/mj/task/{id}/fetch"
-        headers = {
-            "mj-api-secret": self.api_key
-        }
-
-        start_time = time.time()  # 记录开始时间
+        breaker = self.breakers[action]
+        attempt = 0
         while True:
+            if not breaker.allow():
+                logger.warn("[MidJourneyModule] circuit open for %s %s" % (self.domain_name, action))
+                return ProxyError(CIRCUIT_OPEN, "绘图服务暂时不可用，请稍后再试~~~")
+            self.retry_budget.record()
             try:
-                # 发送GET请求
-                response = requests.get(url=api_url, headers=headers, timeout=120.05)
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
                 if response.status_code == 200:
-                    get_image_url_data = response.json()
-                    logger.debug("get_image_url_data: %s" % get_image_url_data)
-                    if get_image_url_data['failReason'] is None:
-                        if get_image_url_data['status'] != 'SUCCESS':
-                            time.sleep(30)
-                            if time.time() - start_time > 300:
-                                return "请求超时，请稍后再试~~~"
-                        else:
-                            return get_image_url_data
-                    else:
-                        return get_image_url_data
-                else:
-                    logger.error("Error occurred: %s" % response.text)
-                    return "哦豁，出现了未知错误，请联系管理员~~~"
+                    breaker.success()
+                    return response.json()
+                logger.error("Error occurred: %s" % response.text)
+                # 4xx说明代理仍在正常响应，是请求本身被拒绝，不计入熔断和后端错误率，也不重试
+                if response.status_code < 500:
+                    breaker.success()
+                    return ProxyError(REJECTED, "哦豁，出现了未知错误，请联系管理员~~~", status=response.status_code)
+                error = ProxyError(HTTP, "哦豁，出现了未知错误，请联系管理员~~~", status=response.status_code)
+            except requests.Timeout as e:
+                logger.error("Error occurred: %s" % str(e))
+                error = ProxyError(TIMEOUT, "绘图服务响应超时，请稍后再试~~~")
             except Exception as e:
                 logger.error("Error occurred: %s" % str(e))
-                return "哦豁，出现了未知错误，请联系管理员~~~"
+                error = ProxyError(NETWORK, "哦豁，出现了未知错误，请联系管理员~~~")
+            breaker.failure()
+            if not retry or attempt >= self.max_retries or not self.retry_budget.withdraw():
+                return error
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+
+    # 检查提交接口的返回，代理拒绝时返回ProxyError
+    def _submitted(self, result):
+        if isinstance(result, ProxyError):
+            return result
+        logger.debug("get_imagine_data: %s" % result)
+        if result.get('code') != 1:
+            return ProxyError(REJECTED, result.get('description') or "任务提交失败")
+        return result
+
+    # 提交出图或垫图任务的函数
+    def get_imagine(self, prompt, base64_data=None):
+        """
+        提交出图或垫图任务
+
+        参数:
+            prompt (str): 提示文本
+            base64_data (str | ImageSource): 图像的base64编码数据或图片来源 (可选)，图片来源以流式请求体发送
+
+        返回:
+            如果任务提交成功，则返回任务结果数据，否则返回ProxyError
+        """
+        data = {"prompt": prompt, "notifyHook": self.notify_hook}
+        api_url = f"{self.domain_name}/mj/submit/imagine"
+
+        # 发送POST请求
+        if isinstance(base64_data, ImageSource):
+            return self._submitted(self._request("imagine", "POST", api_url, headers=self.json_headers,
+                                                 data=JsonStreamBody(data, "base64", base64_data)))
+        data["base64"] = base64_data
+        return self._submitted(self._request("imagine", "POST", api_url, headers=self.headers, json=data))
 
     # 提交变换任务的函数
     def get_simple(self, content):
@@ -96,28 +200,13 @@ class MidJourneyModule:
             content (str): 变换内容
 
         返回:
-            返回任务结果数据
+            如果任务提交成功，则返回任务结果数据，否则返回ProxyError
         """
-        data = {"content": content}
+        data = {"content": content, "notifyHook": self.notify_hook}
         api_url = f"{self.domain_name}/mj/submit/simple-change"
 
-        headers = {
-            "mj-api-secret": self.api_key
-        }
-
         # 发送POST请求
-        try:
-            response = requests.post(url=api_url, headers=headers, json=data, timeout=120.05)
-            if response.status_code == 200:
-                get_imagine_data = response.json()
-                logger.debug("get_imagine_data: %s" % get_imagine_data)
-                return get_imagine_data
-            else:
-                logger.error("Error occurred: %s" % response.text)
-                return "哦豁，出现了未知错误，请联系管理员~~~"
-        except Exception as e:
-            logger.error("Error occurred: %s" % str(e))
-            return "哦豁，出现了未知错误，请联系管理员~~~"
+        return self._submitted(self._request("change", "POST", api_url, headers=self.headers, json=data))
 
     # 提交混合任务的函数
     def submit_blend(self, base64_data, dimensions="SQUARE"):
@@ -125,34 +214,191 @@ class MidJourneyModule:
         提交混合任务
 
         参数:
-            base64_data (list): 包含2到5个元素的图像的base64编码数据
+            base64_data (list): 包含2到5个元素的图像的base64编码数据或图片来源，以流式请求体发送
             dimensions (str): 图像比例（默认为SQUARE）
 
         返回:
-            返回任务结果数据
+            如果任务提交成功，则返回任务结果数据，否则返回ProxyError
         """
         assert isinstance(base64_data, list) and 2 <= len(
             base64_data) <= 5, "base64_data should be a list with 2 to 5 items."
 
         url = f"{self.domain_name}/mj/submit/blend"
-        headers = {"Content-Type": "application/json", "mj-api-secret": self.api_key}
         data = {
-            "base64Array": base64_data,
             "dimensions": dimensions,
-            "notifyHook": "",
+            "notifyHook": self.notify_hook,
             "state": ""
         }
 
-        # 发送POST请求
+        # 发送POST请求，请求体边编码边发送，不再构建完整的JSON字符串
+        return self._submitted(self._request("blend", "POST", url, headers=self.json_headers,
+                                             data=JsonStreamBody(data, "base64Array", base64_data)))
+
+    # 批量查询任务的函数
+    def list_by_condition(self, ids):
+        """
+        批量查询任务
+
+        参数:
+            ids (list): 任务ID列表
+
+        返回:
+            如果查询成功，则返回任务结果数据列表，否则返回ProxyError
+        """
+        api_url = f"{self.domain_name}/mj/task/list-by-condition"
+
+        # 发送POST请求，失败时在重试预算内退避重试
+        list_data = self._request("fetch", "POST", api_url, retry=True, headers=self.headers, json={"ids": ids})
+        if not isinstance(list_data, ProxyError):
+            logger.debug("list_by_condition_data: %s" % list_data)
+        return list_data
+
+
+# 判断任务是否已经结束（成功或失败）
+def is_task_finished(task_data):
+    return task_data.get('failReason') is not None or task_data.get('status') in ('SUCCESS', 'FAILURE')
+
+
+class TaskPoller:
+    # 初始化函数，需要MidJourneyModule对象、轮询间隔和超时时间作为参数，latency_model为耗时统计模型（可选）
+    def __init__(self, mm, interval=10, timeout=300, latency_model=None, min_interval=2, tick=1):
+        self.mm = mm
+        self.interval = interval
+        self.timeout = timeout
+        self.latency_model = latency_model
+        self.min_interval = min_interval
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.thread = None
+
+    # 登记需要轮询的任务
+    def register(self, task_id, callback, delay=0, action="IMAGINE", on_progress=None, progress_interval=None):
+        """
+        登记需要轮询的任务，所有任务共用一个轮询线程
+
+        参数:
+            task_id (str): 任务ID
+            callback (callable): 任务结束后的回调，参数为任务结果数据或ProxyError
+            delay (int): 首次查询前的等待秒数，有耗时统计时按统计结果安排
+            action (str): 任务类型，用于按类型安排查询时间和超时
+            on_progress (callable): 任务进行中的回调（可选），参数为查询到的任务数据
+            progress_interval (int): 设置了on_progress时，两次查询的最长间隔秒数
+        """
+        now = time.time()
+        if self.latency_model is not None and self.latency_model.quantile(action, 0.5) is not None:
+            first_delay = self._next_delay(action, 0)
+        else:
+            first_delay = delay or self.interval
+        if on_progress is not None and progress_interval:
+            first_delay = min(first_delay, progress_interval)
+        with self.lock:
+            self.tasks[task_id] = {"callback": callback, "action": action, "submit": now,
+                                   "next_poll": now + first_delay, "on_progress": on_progress,
+                                   "progress_interval": progress_interval}
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name="mj_poller", daemon=True)
+                self.thread.start()
+
+    # 收到回调推送时立即查询该任务，推送内容只作为唤醒信号，任务状态以代理查询结果为准
+    def wake(self, task_id):
+        """
+        将等待中的任务安排到下一次批量查询
+
+        参数:
+            task_id (str): 回调推送的任务ID
+
+        返回:
+            如果是等待中的任务，则返回True，否则返回False
+        """
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None:
+                return False
+            task["next_poll"] = 0
+        return True
+
+    # 当前仍在轮询的任务数量
+    def pending(self):
+        with self.lock:
+            return len(self.tasks)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.tick)
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.exception("[TaskPoller] poll failed: %s" % e)
+
+    def _next_delay(self, action, elapsed):
+        if self.latency_model is None:
+            return self.interval
+        return self.latency_model.next_delay(action, elapsed, self.min_interval, self.interval)
+
+    def _timeout(self, action):
+        if self.latency_model is None:
+            return self.timeout
+        return self.latency_model.timeout(action, default=self.timeout)
+
+    # 批量查询一次所有到期的任务，并回调已结束的任务
+    def poll_once(self):
+        now = time.time()
+        with self.lock:
+            ids = [task_id for task_id, task in self.tasks.items() if task["next_poll"] <= now]
+        if not ids:
+            return
+
+        finished = {}
+        running = {}
+        list_data = self.mm.list_by_condition(ids)
+        if isinstance(list_data, ProxyError):
+            logger.error("[TaskPoller] list_by_condition failed for %d tasks" % len(ids))
+        else:
+            for task_data in list_data:
+                if is_task_finished(task_data):
+                    finished[task_data['id']] = task_data
+                else:
+                    running[task_data['id']] = task_data
+
+        resolved = []
+        progressed = []
+        with self.lock:
+            for task_id in ids:
+                task = self.tasks.get(task_id)
+                if task is None:
+                    continue
+                elapsed = now - task["submit"]
+                if task_id in finished:
+                    resolved.append((task_id, task, finished[task_id]))
+                elif elapsed > self._timeout(task["action"]):
+                    resolved.append((task_id, task, ProxyError(TASK_TIMEOUT, "请求超时，请稍后再试~~~")))
+                else:
+                    next_delay = self._next_delay(task["action"], elapsed)
+                    if task["on_progress"] is not None:
+                        if task["progress_interval"]:
+                            next_delay = min(next_delay, task["progress_interval"])
+                        if task_id in running:
+                            progressed.append((task_id, task, running[task_id]))
+                    task["next_poll"] = now + next_delay
+                    continue
+                del self.tasks[task_id]
+
+        for task_id, task, task_data in progressed:
+            self._progress(task_id, task, task_data)
+        for task_id, task, result in resolved:
+            self._complete(task_id, task, result)
+
+    def _progress(self, task_id, task, task_data):
         try:
-            response = requests.post(url, headers=headers, data=json.dumps(data))
-            if response.status_code == 200:
-                get_imagine_data = response.json()
-                logger.debug("get_imagine_data: %s" % get_imagine_data)
-                return get_imagine_data
-            else:
-                logger.error("Error occurred: %s" % response.text)
-                return "哦豁，出现了未知错误，请联系管理员~~~"
+            task["on_progress"](task_data)
+        except Exception as e:
+            logger.exception("[TaskPoller] progress callback for task %s failed: %s" % (task_id, e))
+
+    def _complete(self, task_id, task, result):
+        if self.latency_model is not None and not isinstance(result, ProxyError) and result.get('status') == 'SUCCESS':
+            self.latency_model.record(task["action"], result)
+        try:
+            task["callback"](result)
         except Exception as e:
-            logger.error("Error occurred: %s" % str(e))
-            return "哦豁，出现了未知错误，请联系管理员~~~"
+            logger.exception("[TaskPoller] callback for task %s failed: %s" % (task_id, e))
@@ -0,0 +1,80 @@
+import hmac
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from common.log import logger
+
+
+class NotifyServer:
+    # 初始化函数，需要任务轮询对象、监听地址和端口作为参数
+    # secret为回调地址中token参数的值，不匹配的请求被拒绝；max_body为请求体的字节上限
+    def __init__(self, poller, host="127.0.0.1", port=8090, path="/mj/notify", secret="", max_body=64 * 1024):
+        self.poller = poller
+        self.path = path
+        self.secret = secret
+        self.max_body = max_body
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    # 在后台线程中启动监听
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mj_notify", daemon=True)
+        self.thread.start()
+        logger.info("[NotifyServer] listening on %s:%d%s" % (self.server.server_address[0],
+                                                             self.server.server_address[1], self.path))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # 检查请求中的token是否与secret一致
+    def authorized(self, query):
+        token = parse_qs(query).get("token", [""])[0]
+        return bool(self.secret) and hmac.compare_digest(token.encode("utf-8"), self.secret.encode("utf-8"))
+
+    def _handler_class(self):
+        notify_server = self
+
+        class NotifyHandler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logger.debug("[NotifyServer] " + format % args)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path != notify_server.path:
+                    self._respond(404)
+                    return
+                if not notify_server.authorized(url.query):
+                    logger.warn("[NotifyServer] rejected callback from %s without a valid token" %
+                                self.client_address[0])
+                    self._respond(403)
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                except ValueError:
+                    self._respond(400)
+                    return
+                if length > notify_server.max_body:
+                    self._respond(413)
+                    return
+                try:
+                    task_data = json.loads(self.rfile.read(length).decode("utf-8"))
+                except (ValueError, UnicodeDecodeError) as e:
+                    logger.error("[NotifyServer] invalid callback body: %s" % e)
+                    self._respond(400)
+                    return
+                logger.debug("notify_data: %s" % task_data)
+                # 只使用推送中的任务ID，结果以代理查询为准，推送的图片链接和状态不被信任
+                if isinstance(task_data, dict) and task_data.get("id"):
+                    notify_server.poller.wake(str(task_data["id"]))
+                self._respond(200)
+
+            def _respond(self, code):
+                self.send_response(code)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        return NotifyHandler
@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# 将代理返回的进度（如"50%"）转换为整数，无法解析时返回None
+def parse_progress(progress):
+    try:
+        return int(float(str(progress).strip().rstrip("%")))
+    except (TypeError, ValueError):
+        return None
+
+
+class PreviewLimiter:
+    # 进度预览的发送控制，milestones为发送预览的进度百分比，interval为同一会话两次预览的最短间隔秒数
+    # max_tasks为记录的进行中任务数上限
+    def __init__(self, milestones=(50,), interval=30, max_tasks=1000):
+        self.milestones = sorted(m for m in milestones if 0 < m < 100)
+        self.interval = interval
+        self.max_tasks = max_tasks
+        self.lock = threading.Lock()
+        self.reached = OrderedDict()  # 任务ID -> 已经过的最高进度节点
+        self.last_sent = {}  # 会话 -> 上次发送预览的时间
+        self.counters = {"sent": 0, "limited": 0}
+
+    # 判断是否需要发送预览，返回本次经过的进度节点，不需要发送时返回None
+    def due(self, task_id, conversation, progress):
+        """
+        判断任务进度是否经过了新的节点
+
+        参数:
+            task_id (str): 任务ID
+            conversation (str): 接收预览的会话
+            progress (int): 当前进度百分比
+
+        返回:
+            本次经过的最高进度节点；没有经过新节点、任务已结束或会话发送过于频繁时返回None
+        """
+        with self.lock:
+            if task_id not in self.reached:
+                return None
+            passed = [m for m in self.milestones if self.reached[task_id] < m <= progress]
+            if not passed:
+                return None
+            # 一次经过多个节点时只发送最新的预览，被限流的节点也不再补发
+            self.reached[task_id] = passed[-1]
+            now = time.time()
+            if now - self.last_sent.get(conversation, 0) < self.interval:
+                self.counters["limited"] += 1
+                return None
+            self.last_sent[conversation] = now
+            self.counters["sent"] += 1
+            return passed[-1]
+
+    # 登记进行中的任务
+    def start(self, task_id):
+        with self.lock:
+            self.reached[task_id] = 0
+            while len(self.reached) > self.max_tasks:
+                self.reached.popitem(last=False)
+            # 清理长时间没有发送预览的会话
+            expired = [c for c, sent in self.last_sent.items() if time.time() - sent > self.interval]
+            for conversation in expired:
+                del self.last_sent[conversation]
+
+    # 任务结束，之后到达的进度不再发送预览
+    def finish(self, task_id):
+        with self.lock:
+            self.reached.pop(task_id, None)
+
+    # 任务是否仍在进行中
+    def active(self, task_id):
+        with self.lock:
+            return task_id in self.reached
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, tasks=len(self.reached))
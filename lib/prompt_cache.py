@@ -0,0 +1,96 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from common.log import logger
+
+
+# 规范化输入文本，忽略首尾空白、连续空白和大小写的差异
+def normalize_prompt(content):
+    return " ".join(content.split()).lower()
+
+
+class PromptCache:
+    # 初始化函数，需要数据库路径作为参数，max_memory为内存中保留的条数，max_rows为数据库保留的条数，ttl为有效秒数
+    def __init__(self, db_path, max_memory=1000, max_rows=10000, ttl=7 * 24 * 60 * 60):
+        self.max_memory = max_memory
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # (model, content) -> (prompt, created)
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS prompt_cache
+            (Model TEXT, Content TEXT, Prompt TEXT, Created REAL, PRIMARY KEY (Model, Content));
+        """)
+        self.db.commit()
+
+    # 查询优化后的提示词，未命中或已过期返回None
+    def get(self, content, model):
+        """
+        查询优化后的提示词
+
+        参数:
+            content (str): 用户输入的提示文本
+            model (str): 优化使用的模型名称
+
+        返回:
+            命中时返回优化后的提示词，否则返回None
+        """
+        key = (model, normalize_prompt(content))
+        now = time.time()
+        with self.lock:
+            if key in self.memory:
+                prompt, created = self.memory[key]
+                if now - created < self.ttl:
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    return prompt
+                del self.memory[key]
+
+            row = self.db.execute("SELECT Prompt, Created FROM prompt_cache WHERE Model = ? AND Content = ?",
+                                  key).fetchone()
+            if row is None or now - row[1] >= self.ttl:
+                self.misses += 1
+                return None
+            self._remember(key, row[0], row[1])
+            self.hits += 1
+            return row[0]
+
+    # 保存优化后的提示词
+    def put(self, content, model, prompt):
+        key = (model, normalize_prompt(content))
+        now = time.time()
+        with self.lock:
+            self._remember(key, prompt, now)
+            self.db.execute("INSERT OR REPLACE INTO prompt_cache (Model, Content, Prompt, Created) VALUES (?, ?, ?, ?)",
+                            (key[0], key[1], prompt, now))
+            self.puts += 1
+            # 定期清理过期和超出条数上限的记录
+            if self.puts % 100 == 0:
+                self._prune(now)
+            self.db.commit()
+
+    def _remember(self, key, prompt, created):
+        self.memory[key] = (prompt, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory:
+            self.memory.popitem(last=False)
+
+    def _prune(self, now):
+        self.db.execute("DELETE FROM prompt_cache WHERE Created < ?", (now - self.ttl,))
+        self.db.execute("""
+            DELETE FROM prompt_cache WHERE rowid NOT IN
+            (SELECT rowid FROM prompt_cache ORDER BY Created DESC LIMIT ?)
+        """, (self.max_rows,))
+        logger.debug("[PromptCache] pruned, stats: %s" % self.stats())
+
+    # 获取缓存的统计信息
+    def stats(self):
+        total = self.hits + self.misses
+        return {"memory": len(self.memory), "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
@@ -0,0 +1,82 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from common.log import logger
+
+
+class PromptOptimizer:
+    # 初始化函数，需要优化函数和缓存对象作为参数，budget为最长等待秒数，hedge_delay为发起第二个请求前的等待秒数（0为不发起）
+    def __init__(self, generate, cache=None, budget=10, hedge_delay=0, max_workers=8):
+        self.generate = generate
+        self.cache = cache
+        self.budget = budget
+        self.hedge_delay = hedge_delay
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mj_gpt")
+        self.lock = threading.Lock()
+        self.counters = {"optimized": 0, "cached": 0, "hedged": 0, "fallback": 0, "errors": 0}
+
+    # 优化提示词，超出等待时间或出错时返回None，由调用方使用原始提示词
+    def optimize(self, content, model):
+        """
+        在等待时间内优化提示词，必要时发起第二个请求，先返回的结果生效
+
+        参数:
+            content (str): 用户输入的提示文本
+            model (str): 优化使用的模型名称
+
+        返回:
+            优化后的提示词，超时或出错时返回None
+        """
+        if self.cache is not None:
+            prompt = self.cache.get(content, model)
+            if prompt is not None:
+                self._count("cached")
+                return prompt
+
+        deadline = time.monotonic() + self.budget
+        pending = {self._submit(content, model)}
+        hedged = not self.hedge_delay or self.hedge_delay >= self.budget
+        while pending:
+            if hedged:
+                timeout = deadline - time.monotonic()
+            else:
+                timeout = deadline - self.budget + self.hedge_delay - time.monotonic()
+            done, pending = wait(pending, timeout=max(0.0, timeout), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self._count("optimized")
+                    return future.result()
+            if not hedged:
+                # 第一个请求较慢或失败，发起第二个请求
+                hedged = True
+                self._count("hedged")
+                pending.add(self._submit(content, model))
+            elif time.monotonic() >= deadline:
+                break
+
+        self._count("fallback")
+        logger.warn("[PromptOptimizer] prompt optimization exceeded %ss or failed, using raw prompt" % self.budget)
+        return None
+
+    def _submit(self, content, model):
+        future = self.executor.submit(self.generate, content, self.budget)
+        future.add_done_callback(lambda f: self._on_done(f, content, model))
+        return future
+
+    # 请求结束后写入缓存，超时返回的结果也能被下一次请求复用
+    def _on_done(self, future, content, model):
+        if future.exception() is not None:
+            self._count("errors")
+            logger.error("[PromptOptimizer] generate failed: %s" % future.exception())
+        elif self.cache is not None:
+            self.cache.put(content, model, future.result())
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    # 获取统计信息
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
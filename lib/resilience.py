@@ -0,0 +1,124 @@
+import random
+import threading
+import time
+from collections import deque
+
+# 错误类型：网络错误、请求超时、5xx响应、代理拒绝（业务错误或4xx响应）、熔断中、任务等待超时
+NETWORK = "network"
+TIMEOUT = "timeout"
+HTTP = "http"
+REJECTED = "rejected"
+CIRCUIT_OPEN = "circuit_open"
+TASK_TIMEOUT = "task_timeout"
+
+# 这些错误说明代理本身不可用，计入熔断和后端错误率
+TRANSIENT_KINDS = (NETWORK, TIMEOUT, HTTP)
+
+
+class ProxyError:
+    # 请求代理失败的结构化描述，kind为错误类型，message为发送给用户的提示，status为HTTP状态码（可选）
+    def __init__(self, kind, message, status=None):
+        self.kind = kind
+        self.message = message
+        self.status = status
+
+    # 是否为代理不可用导致的错误
+    @property
+    def transient(self):
+        return self.kind in TRANSIENT_KINDS
+
+    def __str__(self):
+        return self.message
+
+    def __repr__(self):
+        return "ProxyError(%s, %r, status=%s)" % (self.kind, self.message, self.status)
+
+
+class CircuitBreaker:
+    # 初始化函数，failure_threshold为连续失败多少次后熔断，reset_timeout为熔断后多少秒进入半开状态
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    # 熔断器状态：closed（正常）、open（熔断中）、half_open（等待探测结果）
+    def state(self):
+        with self.lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self.probing or time.time() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    # 是否允许发送请求，半开状态下同一时间只放行一个探测请求
+    def allow(self):
+        with self.lock:
+            state = self._state()
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    # 请求成功，关闭熔断器
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    # 请求失败，连续失败达到阈值或探测失败时（重新）熔断
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+            self.probing = False
+
+
+class RetryBudget:
+    # 初始化函数，重试次数不超过window秒内请求数的ratio倍，且至少允许min_retries次
+    def __init__(self, ratio=0.2, min_retries=3, window=10):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self.lock = threading.Lock()
+        self.requests = deque()
+        self.retries = deque()
+        self.exhausted = 0
+
+    # 记录一次请求
+    def record(self):
+        with self.lock:
+            now = time.time()
+            self.requests.append(now)
+            self._trim(now)
+
+    # 申请一次重试，超出预算时返回False
+    def withdraw(self):
+        with self.lock:
+            now = time.time()
+            self._trim(now)
+            if len(self.retries) >= max(self.min_retries, self.ratio * len(self.requests)):
+                self.exhausted += 1
+                return False
+            self.retries.append(now)
+            return True
+
+    def _trim(self, now):
+        for queue in (self.requests, self.retries):
+            while queue and now - queue[0] > self.window:
+                queue.popleft()
+
+
+# 指数退避的等待秒数，在[0, min(cap, base * 2^attempt)]之间随机，避免多个请求同时重试
+def backoff_delay(attempt, base=0.5, cap=8):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from common.log import logger
+
+
+class ResultCache:
+    # 初始化函数，需要缓存目录和字节上限作为参数
+    def __init__(self, directory, max_bytes=200 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # 文件名 -> 字节数，按最近使用排序
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._load()
+
+    # 扫描缓存目录重建索引，清理写入中断留下的临时文件
+    def _load(self):
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total_bytes += size
+        self._evict()
+        logger.info("[ResultCache] loaded %d entries, %d bytes" % (len(self.entries), self.total_bytes))
+
+    # 根据任务ID、图片链接和压缩规格生成缓存文件名
+    @staticmethod
+    def make_key(task_id, url, variant):
+        url_hash = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+        return f"{task_id}-{url_hash}-{variant}"
+
+    # 读取缓存，未命中返回None
+    def get(self, task_id, url, variant):
+        """
+        读取缓存的图片数据
+
+        参数:
+            task_id (str): 任务ID
+            url (str): 图片链接
+            variant (str): 压缩规格，不同频道类型使用不同的规格
+
+        返回:
+            命中时返回图片数据，否则返回None
+        """
+        name = self.make_key(task_id, url, variant)
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            if name not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # 更新修改时间，重启后仍能保持最近使用顺序
+        except OSError as e:
+            logger.warn("[ResultCache] failed to read %s: %s" % (name, e))
+            with self.lock:
+                self.total_bytes -= self.entries.pop(name, 0)
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return data
+
+    # 写入缓存，先写临时文件再替换，进程崩溃不会留下不完整的缓存
+    def put(self, task_id, url, variant, data):
+        """
+        写入图片数据，超过字节上限时按最近最少使用淘汰
+
+        参数:
+            task_id (str): 任务ID
+            url (str): 图片链接
+            variant (str): 压缩规格
+            data (bytes): 图片数据
+        """
+        if len(data) > self.max_bytes:
+            return
+        name = self.make_key(task_id, url, variant)
+        path = os.path.join(self.directory, name)
+        tmp_path = "%s.%d.tmp" % (path, threading.get_ident())
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warn("[ResultCache] failed to write %s: %s" % (name, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self.lock:
+            self.total_bytes += len(data) - self.entries.pop(name, 0)
+            self.entries[name] = len(data)
+        self._evict()
+
+    # 淘汰最近最少使用的缓存，直到总大小不超过上限
+    def _evict(self):
+        while True:
+            with self.lock:
+                if self.total_bytes <= self.max_bytes or not self.entries:
+                    return
+                name, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+                self.evictions += 1
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    # 获取缓存的统计信息
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.total_bytes, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
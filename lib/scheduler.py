@@ -0,0 +1,118 @@
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from common.log import logger
+
+# 变换（U/V）任务使用快速通道，出图和合图使用普通通道
+LANE_CHANGE = "change"
+LANE_IMAGINE = "imagine"
+
+
+class SubmitScheduler:
+    # 初始化函数，max_in_flight为同时在代理中执行的任务上限，reserved_change为给快速通道预留的名额，max_queue为本地排队上限
+    def __init__(self, max_in_flight=3, reserved_change=1, max_queue=100, max_workers=4):
+        self.max_in_flight = max_in_flight
+        self.reserved_change = min(reserved_change, max_in_flight - 1)
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mj_submit")
+        self.lock = threading.Lock()
+        # 每个通道按用户分组排队，用户之间轮询，防止单个用户占满队列
+        self.lanes = {LANE_CHANGE: OrderedDict(), LANE_IMAGINE: OrderedDict()}
+        self.in_flight = {LANE_CHANGE: 0, LANE_IMAGINE: 0}
+        self.queued = 0
+        self.counters = {"submitted": 0, "queued": 0, "rejected": 0}
+
+    # 提交一个任务，有空闲名额时立即执行，否则排队
+    def submit(self, user_id, lane, job):
+        """
+        提交一个任务
+
+        参数:
+            user_id (str): 会话ID，同一通道内不同用户之间轮询
+            lane (str): 通道，LANE_CHANGE或LANE_IMAGINE
+            job (callable): 获得名额后在后台线程中执行，返回True表示任务已提交到代理并占用名额，
+                            任务结束时需要调用release；返回False表示提交失败，名额立即释放
+
+        返回:
+            排队位置，0表示已立即执行，-1表示队列已满
+        """
+        with self.lock:
+            if self.queued >= self.max_queue:
+                self.counters["rejected"] += 1
+                return -1
+            self.lanes[lane].setdefault(user_id, deque()).append(job)
+            self.queued += 1
+            position = self._position(user_id, lane)
+            dispatched = self._dispatch()
+            if any(item is job for _, _, item in dispatched):
+                position = 0
+            else:
+                self.counters["queued"] += 1
+        for item in dispatched:
+            self.executor.submit(self._run, *item)
+        return position
+
+    # 任务在代理中结束后释放名额，并调度排队中的任务
+    def release(self, lane):
+        with self.lock:
+            self.in_flight[lane] -= 1
+            dispatched = self._dispatch()
+        for item in dispatched:
+            self.executor.submit(self._run, *item)
+
+    # 获取统计信息
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, queued_now=self.queued, in_flight=dict(self.in_flight))
+
+    def _run(self, lane, user_id, job):
+        occupied = False
+        try:
+            occupied = job()
+        except Exception as e:
+            logger.exception("[SubmitScheduler] job for %s failed: %s" % (user_id, e))
+        if not occupied:
+            self.release(lane)
+
+    # 在名额允许的范围内取出任务，快速通道优先，普通通道最多使用max_in_flight - reserved_change个名额
+    def _dispatch(self):
+        dispatched = []
+        while True:
+            total = self.in_flight[LANE_CHANGE] + self.in_flight[LANE_IMAGINE]
+            if total >= self.max_in_flight:
+                break
+            if self.lanes[LANE_CHANGE]:
+                lane = LANE_CHANGE
+            elif self.lanes[LANE_IMAGINE] and \
+                    self.in_flight[LANE_IMAGINE] < self.max_in_flight - self.reserved_change:
+                lane = LANE_IMAGINE
+            else:
+                break
+            users = self.lanes[lane]
+            user_id, jobs = next(iter(users.items()))
+            job = jobs.popleft()
+            # 该用户还有任务时移到队尾，实现用户之间的轮询
+            del users[user_id]
+            if jobs:
+                users[user_id] = jobs
+            self.queued -= 1
+            self.in_flight[lane] += 1
+            self.counters["submitted"] += 1
+            dispatched.append((lane, user_id, job))
+        return dispatched
+
+    # 估算任务的排队位置：快速通道的任务排在普通通道之前，同一通道内按用户轮询
+    def _position(self, user_id, lane):
+        users = self.lanes[lane]
+        rounds = len(users[user_id]) - 1
+        ahead = rounds
+        before_me = True
+        for other, jobs in users.items():
+            if other == user_id:
+                before_me = False
+                continue
+            ahead += min(len(jobs), rounds + 1 if before_me else rounds)
+        if lane == LANE_IMAGINE:
+            ahead += sum(len(jobs) for jobs in self.lanes[LANE_CHANGE].values())
+        return ahead + 1
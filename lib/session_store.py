@@ -0,0 +1,145 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+from common.log import logger
+
+
+class SessionStore:
+    # 初始化函数，需要暂存目录作为参数，ttl为会话闲置的有效秒数，max_bytes和max_user_bytes为全部和单个用户的图片字节上限
+    def __init__(self, spool_dir, ttl=600, max_bytes=200 * 1024 * 1024, max_user_bytes=50 * 1024 * 1024):
+        self.spool_dir = spool_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_user_bytes = max_user_bytes
+        self.lock = threading.Lock()
+        self.sessions = {}  # user_id -> {"params": dict, "files": [(path, size)], "bytes": int, "active": float}
+        self.total_bytes = 0  # 包括已取出、等待提交后删除的图片
+        self.detached = {}  # 已取出的暂存图片路径 -> 字节数，release后才从total_bytes中扣除
+        self.sequence = 0  # 暂存文件序号，已取出等待提交的图片不会被同一用户的新会话覆盖
+        # 启动时清理上次运行遗留的暂存文件
+        if os.path.exists(spool_dir):
+            shutil.rmtree(spool_dir, ignore_errors=True)
+        os.makedirs(spool_dir)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    # 创建会话，只在内存中保存参数，已有的会话会被替换
+    def create(self, user_id, params):
+        with self.lock:
+            self._sweep()
+            self._drop(user_id)
+            self.sessions[user_id] = {"params": params, "files": [], "bytes": 0, "active": time.time()}
+
+    # 获取会话参数，过期的会话视为不存在
+    def get(self, user_id):
+        with self.lock:
+            self._sweep()
+            session = self.sessions.get(user_id)
+            if session is None:
+                return None
+            session["active"] = time.time()
+            return session["params"]
+
+    # 将上传的图片复制到暂存目录，会话中只保存文件路径
+    def add_file(self, user_id, path):
+        """
+        将上传的图片复制到暂存目录
+
+        参数:
+            user_id (str): 会话ID
+            path (str): 上传图片的本地路径
+
+        返回:
+            成功返回None，超出字节上限或会话不存在时返回错误描述
+        """
+        size = os.path.getsize(path)
+        with self.lock:
+            self._sweep()
+            session = self.sessions.get(user_id)
+            if session is None:
+                return "会话已过期，请重新发送指令"
+            if session["bytes"] + size > self.max_user_bytes:
+                return "图片总大小超出限制，请发送更小的图片"
+            # 全局超出上限时，先淘汰最久未活动的其他会话
+            while self.total_bytes + size > self.max_bytes:
+                idle = [(s["active"], uid) for uid, s in self.sessions.items() if uid != user_id and s["bytes"]]
+                if not idle:
+                    return "当前待处理的图片过多，请稍后再试"
+                evicted = min(idle)[1]
+                logger.info("[SessionStore] evict session %s to free space" % evicted)
+                self._drop(evicted)
+            self.sequence += 1
+            name = "%s_%d%s" % (hashlib.md5(user_id.encode("utf-8")).hexdigest()[:16], self.sequence,
+                                os.path.splitext(path)[1])
+            spool_path = os.path.join(self.spool_dir, name)
+            session["files"].append((spool_path, size))
+            session["bytes"] += size
+            session["active"] = time.time()
+            self.total_bytes += size
+        try:
+            shutil.copyfile(path, spool_path)
+        except OSError as e:
+            logger.error("[SessionStore] failed to spool %s: %s" % (path, e))
+            with self.lock:
+                self._drop(user_id)
+            return "图片保存失败，请重新发送指令"
+        return None
+
+    # 获取会话中已暂存的图片路径
+    def files(self, user_id):
+        with self.lock:
+            session = self.sessions.get(user_id)
+            return [path for path, _ in session["files"]] if session else []
+
+    # 取出会话中暂存的图片并移除会话，图片由调用方在使用后通过release删除，删除前仍计入字节上限
+    def detach(self, user_id):
+        with self.lock:
+            session = self.sessions.pop(user_id, None)
+            if session is None:
+                return []
+            self.detached.update(session["files"])
+            return [path for path, _ in session["files"]]
+
+    # 删除已取出的暂存图片，并从字节上限中扣除，重复调用不会重复扣除
+    def release(self, paths):
+        with self.lock:
+            for path in paths:
+                self.total_bytes -= self.detached.pop(path, 0)
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # 删除会话及其暂存的图片
+    def discard(self, user_id):
+        with self.lock:
+            self._drop(user_id)
+
+    # 获取统计信息
+    def stats(self):
+        with self.lock:
+            return {"sessions": len(self.sessions), "bytes": self.total_bytes,
+                    "detached_bytes": sum(self.detached.values())}
+
+    def _drop(self, user_id):
+        session = self.sessions.pop(user_id, None)
+        if session is None:
+            return
+        for path, size in session["files"]:
+            self.total_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # 清理闲置超时的会话
+    def _sweep(self):
+        now = time.time()
+        for user_id in [uid for uid, s in self.sessions.items() if now - s["active"] > self.ttl]:
+            logger.debug("[SessionStore] session %s expired" % user_id)
+            self._drop(user_id)
@@ -0,0 +1,70 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from common.log import logger
+from plugins.midjourney_turbo.lib.midJourney_module import TaskPoller
+
+
+class TaskEngine:
+    # 初始化函数，需要MidJourneyModule对象、发送线程数和轮询间隔作为参数，latency_model为耗时统计模型（可选）
+    def __init__(self, mm, max_workers=4, poll_interval=10, latency_model=None, min_interval=2):
+        self.mm = mm
+        self.poller = TaskPoller(mm=mm, interval=poll_interval, latency_model=latency_model,
+                                 min_interval=min_interval)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mj_task")
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    # 登记一个已提交的任务，在后台等待其完成
+    def track(self, task_id, callback, delay=0, action="IMAGINE", on_progress=None, progress_interval=None):
+        """
+        登记一个已提交的任务，由共享的轮询线程批量查询进度直到完成
+
+        参数:
+            task_id (str): 提交任务返回的任务ID
+            callback (callable): 任务结束后的回调，参数为任务结果数据或ProxyError，在后台线程中执行
+            delay (int): 首次查询前的等待秒数，没有耗时统计时使用
+            action (str): 任务类型，如IMAGINE、UPSCALE、VARIATION、BLEND
+            on_progress (callable): 任务进行中的回调（可选），参数为任务数据，在后台线程中执行
+            progress_interval (int): 设置了on_progress时，两次查询的最长间隔秒数
+        """
+        with self.lock:
+            self.pending.add(task_id)
+        if on_progress is not None:
+            progress = lambda task_data: self.executor.submit(self._progress, task_id, on_progress, task_data)
+        else:
+            progress = None
+        self.poller.register(task_id, lambda task_data: self.executor.submit(self._run, task_id, callback, task_data),
+                             delay=delay, action=action, on_progress=progress, progress_interval=progress_interval)
+        logger.debug("[TaskEngine] task %s tracked, in flight: %d" % (task_id, len(self.pending)))
+
+    # 直接在后台交付已结束任务的结果，用于重新发送本地记录的任务
+    def redeliver(self, task_id, callback, task_data):
+        with self.lock:
+            self.pending.add(task_id)
+        self.executor.submit(self._run, task_id, callback, task_data)
+
+    # 任务是否仍在后台等待结果或交付中
+    def tracking(self, task_id):
+        with self.lock:
+            return task_id in self.pending
+
+    # 当前仍在等待结果的任务数量
+    def in_flight(self):
+        with self.lock:
+            return len(self.pending)
+
+    def _progress(self, task_id, on_progress, task_data):
+        try:
+            on_progress(task_data)
+        except Exception as e:
+            logger.exception("[TaskEngine] progress of task %s failed: %s" % (task_id, e))
+
+    def _run(self, task_id, callback, task_data):
+        try:
+            callback(task_data)
+        except Exception as e:
+            logger.exception("[TaskEngine] task %s failed: %s" % (task_id, e))
+        finally:
+            with self.lock:
+                self.pending.discard(task_id)
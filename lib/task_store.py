@@ -0,0 +1,79 @@
+import json
+import sqlite3
+import threading
+import time
+
+from common.log import logger
+
+
+class TaskStore:
+    # 初始化函数，需要数据库路径作为参数，retention为任务记录保留的秒数
+    def __init__(self, db_path, retention=30 * 86400):
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0}
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS midjourney_task
+            (ID TEXT PRIMARY KEY, Action TEXT, Status TEXT, Data TEXT, Updated REAL, Backend TEXT);
+        """)
+        # 兼容没有Backend列的旧表
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(midjourney_task)")]
+        if "Backend" not in columns:
+            self.db.execute("ALTER TABLE midjourney_task ADD COLUMN Backend TEXT")
+        # 启动时清理过期的任务记录
+        cur = self.db.execute("DELETE FROM midjourney_task WHERE Updated < ?", (time.time() - retention,))
+        self.db.commit()
+        if cur.rowcount:
+            logger.info("[TaskStore] removed %d expired tasks" % cur.rowcount)
+
+    # 记录已提交但尚未结束的任务，已有的记录不会被覆盖，backend为任务所在后端的名称
+    def submitted(self, task_id, action, backend=None):
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO midjourney_task (ID, Action, Status, Data, Updated, Backend) "
+                            "VALUES (?, ?, 'SUBMITTED', NULL, ?, ?)", (task_id, action, time.time(), backend))
+            self.db.commit()
+
+    # 记录已结束的任务结果
+    def put(self, task_data):
+        status = task_data.get("status") or ("FAILURE" if task_data.get("failReason") else "SUCCESS")
+        with self.lock:
+            self.db.execute("""
+                INSERT INTO midjourney_task (ID, Action, Status, Data, Updated) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(ID) DO UPDATE SET Action = COALESCE(excluded.Action, Action),
+                    Status = excluded.Status, Data = excluded.Data, Updated = excluded.Updated
+            """, (task_data["id"], task_data.get("action"), status, json.dumps(task_data, ensure_ascii=False),
+                  time.time()))
+            self.db.commit()
+
+    # 获取任务记录
+    def get(self, task_id):
+        """
+        获取任务记录
+
+        参数:
+            task_id (str): 任务ID
+
+        返回:
+            (状态, 任务结果数据)，状态为SUBMITTED、SUCCESS或FAILURE，未结束的任务数据为None；未知任务返回(None, None)
+        """
+        with self.lock:
+            row = self.db.execute("SELECT Status, Data FROM midjourney_task WHERE ID = ?", (task_id,)).fetchone()
+            self.counters["hits" if row else "misses"] += 1
+        if row is None:
+            return None, None
+        return row[0], json.loads(row[1]) if row[1] else None
+
+    # 获取任务所在后端的名称，未知任务或旧记录返回None
+    def backend(self, task_id):
+        with self.lock:
+            row = self.db.execute("SELECT Backend FROM midjourney_task WHERE ID = ?", (task_id,)).fetchone()
+        return row[0] if row else None
+
+    # 获取统计信息
+    def stats(self):
+        with self.lock:
+            total = self.db.execute("SELECT COUNT(*) FROM midjourney_task").fetchone()[0]
+            return dict(self.counters, tasks=total)
@@ -0,0 +1,128 @@
+import json
+import os
+import threading
+import time
+
+from common.log import logger
+
+TRACE_VERSION = 1
+
+# 请求分类：出图、垫图、合图、变换、重新获取结果、运行统计、上传图片
+IMAGINE = "imagine"
+IMAGE_PROMPT = "image_prompt"
+BLEND = "blend"
+CHANGE = "change"
+REDELIVER = "redeliver"
+STATS = "stats"
+IMAGE = "image"
+
+
+class TraceRecorder:
+    # 记录请求到达的匿名轨迹，每行一个JSON，只保存请求分类、提示词长度、图片尺寸和到达间隔，不保存内容和用户ID
+    # max_bytes为轨迹文件的上限，超出后停止记录
+    def __init__(self, path, image_ins="/p", blend_ins="/b", change_ins="/c", stats_ins="/stats",
+                 max_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.image_ins = image_ins
+        self.blend_ins = blend_ins
+        self.change_ins = change_ins
+        self.stats_ins = stats_ins
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.users = {}  # 会话ID -> 轨迹内的序号
+        self.last_arrival = None
+        self.recorded = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+        self.bytes = self.file.tell()
+        # 每次启动写入一行文件头，回放时从这里重新计算到达间隔
+        self._write({"trace": TRACE_VERSION, "started": int(time.time())})
+
+    # 对文本请求分类，返回(分类, 附加字段)
+    def classify(self, content):
+        content = content.strip()
+        if content == self.stats_ins:
+            return STATS, {}
+        if self.image_ins in content:
+            return IMAGE_PROMPT, {"len": len(content.replace(self.image_ins, "").strip())}
+        if self.blend_ins in content:
+            parts = content.split()
+            return BLEND, {"n": int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0}
+        if self.change_ins in content:
+            parts = content.replace(self.change_ins, "").split()
+            if len(parts) > 1:
+                return CHANGE, {"btn": parts[1][:2].upper()}
+            return REDELIVER, {}
+        return IMAGINE, {"len": len(content)}
+
+    # 记录一次请求，arrival为请求到达时间，image_path为已下载的图片
+    def record(self, context, arrival=None, image_path=None):
+        arrival = arrival or time.time()
+        if context.type.name == "IMAGE":
+            cmd, extra = IMAGE, self._image_size(image_path or context.content)
+        else:
+            cmd, extra = self.classify(context.content)
+        with self.lock:
+            if self.file is None:
+                return
+            user_id = context.kwargs.get("session_id")
+            if user_id not in self.users:
+                self.users[user_id] = len(self.users)
+            dt = 0.0 if self.last_arrival is None else max(0.0, arrival - self.last_arrival)
+            self.last_arrival = arrival
+            self.recorded += 1
+            self._write({"dt": round(dt, 3), "type": context.type.name, "cmd": cmd, "user": self.users[user_id],
+                         "group": 1 if context.kwargs.get("isgroup") else 0, **extra})
+
+    def stats(self):
+        with self.lock:
+            return {"recorded": self.recorded, "users": len(self.users), "bytes": self.bytes,
+                    "stopped": self.file is None}
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    # 读取图片的尺寸和文件大小，只解析文件头
+    @staticmethod
+    def _image_size(path):
+        from PIL import Image
+
+        try:
+            with Image.open(path) as image:
+                return {"w": image.width, "h": image.height, "bytes": os.path.getsize(path)}
+        except Exception:
+            return {}
+
+    def _write(self, entry):
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        if self.bytes + len(line) > self.max_bytes:
+            logger.warn("[TraceRecorder] %s reached %d bytes, recording stopped" % (self.path, self.max_bytes))
+            self.file.close()
+            self.file = None
+            return
+        self.file.write(line)
+        self.file.flush()
+        self.bytes += len(line)
+
+
+# 读取轨迹文件，返回请求列表，offset为相对于第一个请求的到达秒数，多次启动的记录按顺序首尾相接
+def load_trace(path):
+    entries = []
+    offset = 0.0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if "trace" in entry:
+                continue
+            if entries:
+                offset += entry.get("dt", 0.0)
+            entry["offset"] = offset
+            entries.append(entry)
+    return entries
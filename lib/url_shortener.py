@@ -0,0 +1,146 @@
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from common.log import logger
+
+BASE62 = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+# 将非负整数编码为base62字符串
+def base62_encode(number):
+    if number == 0:
+        return BASE62[0]
+    chars = []
+    while number:
+        number, rem = divmod(number, 62)
+        chars.append(BASE62[rem])
+    return "".join(reversed(chars))
+
+
+class LocalShortener:
+    # 内置短链接，链接保存在SQLite中，key_length为随机key的长度（随机生成，无法按顺序遍历其他用户的图片）
+    # base_url为对外访问重定向服务的地址，retention为短链接保留的秒数
+    def __init__(self, db_path, base_url, key_length=7, retention=30 * 86400):
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.key_length = key_length
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS midjourney_short_url
+            (Key TEXT PRIMARY KEY, Url TEXT UNIQUE NOT NULL, Created REAL);
+        """)
+        # 启动时清理过期的短链接
+        cur = self.db.execute("DELETE FROM midjourney_short_url WHERE Created < ?", (time.time() - retention,))
+        self.db.commit()
+        if cur.rowcount:
+            logger.info("[LocalShortener] removed %d expired short urls" % cur.rowcount)
+
+    # 生成短链接，同一个图片链接始终返回同一个key
+    def shorten(self, url):
+        with self.lock:
+            row = self.db.execute("SELECT Key FROM midjourney_short_url WHERE Url = ?", (url,)).fetchone()
+            while row is None:
+                key = base62_encode(secrets.randbelow(62 ** self.key_length)).rjust(self.key_length, BASE62[0])
+                try:
+                    self.db.execute("INSERT INTO midjourney_short_url (Key, Url, Created) VALUES (?, ?, ?)",
+                                    (key, url, time.time()))
+                    self.db.commit()
+                    row = (key,)
+                except sqlite3.IntegrityError:
+                    # key冲突时重新生成
+                    row = self.db.execute("SELECT Key FROM midjourney_short_url WHERE Url = ?", (url,)).fetchone()
+        return self.base_url + row[0]
+
+    # 根据key获取原始链接，不存在时返回None
+    def resolve(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT Url FROM midjourney_short_url WHERE Key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+
+class ShortUrlCache:
+    # 短链接结果缓存，shorten为生成短链接的函数，同一个图片链接只请求一次，size为缓存的链接数
+    # max_workers为后台生成短链接的线程数，生成过程可以与图片发送同时进行
+    def __init__(self, shorten, size=2048, max_workers=4):
+        self.shorten = shorten
+        self.size = size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mj_short_url")
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # 图片链接 -> 短链接
+        self.counters = {"hits": 0, "misses": 0, "errors": 0}
+
+    # 获取短链接，生成失败时返回原始链接且不缓存
+    def get(self, url):
+        with self.lock:
+            short_url = self.entries.get(url)
+            if short_url is not None:
+                self.entries.move_to_end(url)
+                self.counters["hits"] += 1
+                return short_url
+            self.counters["misses"] += 1
+        try:
+            short_url = self.shorten(url)
+        except Exception as e:
+            logger.error("[ShortUrlCache] shorten %s failed: %s" % (url, e))
+            with self.lock:
+                self.counters["errors"] += 1
+            return url
+        with self.lock:
+            self.entries[url] = short_url
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return short_url
+
+    # 在后台生成短链接，返回Future
+    def submit(self, url):
+        return self.executor.submit(self.get, url)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries))
+
+
+class ShortUrlServer:
+    # 内置短链接的重定向服务，GET /<key> 返回302跳转到原始链接
+    def __init__(self, shortener, host="0.0.0.0", port=8091):
+        self.shortener = shortener
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    # 在后台线程中启动监听
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mj_short_url", daemon=True)
+        self.thread.start()
+        logger.info("[ShortUrlServer] listening on %s:%d" % self.server.server_address[:2])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler_class(self):
+        shortener = self.shortener
+
+        class ShortUrlHandler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logger.debug("[ShortUrlServer] " + format % args)
+
+            def do_GET(self):
+                key = self.path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+                url = shortener.resolve(key) if key else None
+                self.send_response(302 if url else 404)
+                if url:
+                    self.send_header("Location", url)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            do_HEAD = do_GET
+
+        return ShortUrlHandler
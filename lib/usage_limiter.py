@@ -0,0 +1,133 @@
+import datetime
+import sqlite3
+import threading
+import time
+
+from common.log import logger
+
+
+class UsageLimiter:
+    # 初始化函数，需要数据库路径和每日试用次数作为参数，write_behind为是否使用内存计数并定期写回数据库
+    def __init__(self, db_path, trial_lock, write_behind=False, flush_interval=5):
+        self.trial_lock = trial_lock
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.counters = {}  # UserID -> [TrialCount, TrialDate]，仅write_behind模式使用
+        self.dirty = set()
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        # 表结构只在启动时创建一次，WAL模式下读写互不阻塞
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS midjourneyturbo
+            (UserID TEXT PRIMARY KEY, TrialCount INTEGER, TrialDate TEXT);
+        """)
+        self.db.commit()
+        if write_behind:
+            threading.Thread(target=self._flush_loop, name="mj_usage_flush", daemon=True).start()
+
+    # 检查并扣减一次使用次数
+    def check_and_update(self, user_id):
+        """
+        检查并扣减一次使用次数，日期变化时重置次数
+
+        参数:
+            user_id (str): 会话ID
+
+        返回:
+            (是否放行, 是否提示剩余次数, 剩余次数)，次数用完时返回(False, False, "")
+        """
+        today = datetime.date.today().isoformat()
+        if self.write_behind:
+            return self._consume_memory(user_id, today)
+        return self._consume_db(user_id, today)
+
+    # 使用一条UPSERT语句原子地完成插入、跨日重置和扣减，次数用完时不更新任何行
+    def _consume_db(self, user_id, today):
+        with self.lock:
+            cur = self.db.execute("""
+                INSERT INTO midjourneyturbo (UserID, TrialCount, TrialDate) VALUES (?, ?, ?)
+                ON CONFLICT(UserID) DO UPDATE SET
+                    TrialCount = CASE WHEN TrialDate = excluded.TrialDate
+                        THEN COALESCE(TrialCount, ?) - 1 ELSE excluded.TrialCount END,
+                    TrialDate = excluded.TrialDate
+                WHERE TrialDate IS NOT excluded.TrialDate OR COALESCE(TrialCount, ?) > 0
+            """, (user_id, self.trial_lock - 1, today, self.trial_lock, self.trial_lock))
+            if cur.rowcount == 0:
+                self.db.commit()
+                return False, False, ""
+            row = self.db.execute("SELECT TrialCount FROM midjourneyturbo WHERE UserID = ?", (user_id,)).fetchone()
+            self.db.commit()
+        return True, True, row[0]
+
+    # 在内存中检查并扣减，修改过的用户由后台线程定期写回数据库
+    def _consume_memory(self, user_id, today):
+        with self.lock:
+            counter = self.counters.get(user_id)
+            if counter is None:
+                row = self.db.execute("SELECT TrialCount, TrialDate FROM midjourneyturbo WHERE UserID = ?",
+                                      (user_id,)).fetchone()
+                trial_count = row[0] if row and row[0] is not None else self.trial_lock
+                counter = [trial_count, row[1] if row else None]
+                self.counters[user_id] = counter
+
+            if counter[1] != today:  # 日期不是今天，重置试用次数
+                counter[0], counter[1] = self.trial_lock, today
+            if counter[0] <= 0:  # 今天的试用次数已经用完
+                return False, False, ""
+            counter[0] -= 1
+            self.dirty.add(user_id)
+            return True, True, counter[0]
+
+    # 退还一次当天扣减的使用次数，如同一会话重复提交的任务被合并时
+    def refund(self, user_id):
+        """
+        退还一次使用次数，不超过每日试用次数，日期变化后不再退还
+
+        参数:
+            user_id (str): 会话ID
+
+        返回:
+            退还后的剩余次数，没有当天的扣减记录时返回None
+        """
+        today = datetime.date.today().isoformat()
+        with self.lock:
+            if self.write_behind:
+                counter = self.counters.get(user_id)
+                if counter is None or counter[1] != today:
+                    return None
+                counter[0] = min(counter[0] + 1, self.trial_lock)
+                self.dirty.add(user_id)
+                return counter[0]
+            cur = self.db.execute("""
+                UPDATE midjourneyturbo SET TrialCount = MIN(TrialCount + 1, ?) WHERE UserID = ? AND TrialDate = ?
+            """, (self.trial_lock, user_id, today))
+            if cur.rowcount == 0:
+                self.db.commit()
+                return None
+            row = self.db.execute("SELECT TrialCount FROM midjourneyturbo WHERE UserID = ?", (user_id,)).fetchone()
+            self.db.commit()
+        return row[0]
+
+    # 将内存中修改过的计数写回数据库
+    def flush(self):
+        with self.lock:
+            rows = [(user_id, self.counters[user_id][0], self.counters[user_id][1]) for user_id in self.dirty]
+            self.dirty.clear()
+            if not rows:
+                return
+            self.db.executemany("""
+                INSERT INTO midjourneyturbo (UserID, TrialCount, TrialDate) VALUES (?, ?, ?)
+                ON CONFLICT(UserID) DO UPDATE SET TrialCount = excluded.TrialCount, TrialDate = excluded.TrialDate
+            """, rows)
+            self.db.commit()
+        logger.debug("[UsageLimiter] flushed %d users" % len(rows))
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("[UsageLimiter] flush failed: %s" % e)
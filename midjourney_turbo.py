@@ -5,57 +5,46 @@
 @Project ：chatgpt-on-wechat
 @file: midjourney_turbo.py
 """
-import base64
-import datetime
 import json
+import mimetypes
 import re
-import sqlite3
+import secrets
 import threading
 import time
-import openai
 import requests
 import io
 import os
-
-from PIL import Image
-from plugins.midjourney_turbo.lib.midJourney_module import MidJourneyModule
+import tempfile
+from contextlib import nullcontext
+
+from plugins.midjourney_turbo.lib.midJourney_module import ImageSource, create_session, is_task_finished
+from plugins.midjourney_turbo.lib.backend_pool import BackendPool, parse_backends
+from plugins.midjourney_turbo.lib.channels import resolve_channel
+from plugins.midjourney_turbo.lib.coalescer import Coalescer, file_digest
+from plugins.midjourney_turbo.lib.delivery_queue import DeliveryQueue
+from plugins.midjourney_turbo.lib.latency_model import LatencyModel
+from plugins.midjourney_turbo.lib.metrics import Metrics, MetricsExporter
+from plugins.midjourney_turbo.lib.notify_server import NotifyServer
+from plugins.midjourney_turbo.lib.preview import PreviewLimiter, parse_progress
+from plugins.midjourney_turbo.lib.prompt_cache import PromptCache
+from plugins.midjourney_turbo.lib.prompt_optimizer import PromptOptimizer
+from plugins.midjourney_turbo.lib.resilience import ProxyError
+from plugins.midjourney_turbo.lib.result_cache import ResultCache
+from plugins.midjourney_turbo.lib.scheduler import LANE_CHANGE, LANE_IMAGINE, SubmitScheduler
+from plugins.midjourney_turbo.lib.session_store import SessionStore
+from plugins.midjourney_turbo.lib.task_engine import TaskEngine
+from plugins.midjourney_turbo.lib.task_store import TaskStore
+from plugins.midjourney_turbo.lib.trace_recorder import TraceRecorder
+from plugins.midjourney_turbo.lib.url_shortener import LocalShortener, ShortUrlCache, ShortUrlServer
+from plugins.midjourney_turbo.lib.usage_limiter import UsageLimiter
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
-from channel.wechatcom.wechatcomapp_channel import WechatComAppChannel
-from channel.wechat.wechat_channel import WechatChannel
-from channel.wechatmp.wechatmp_channel import WechatMPChannel
-from config import conf
+from config import conf, global_config
 import plugins
 from plugins import *
 from common.log import logger
-from common.expired_dict import ExpiredDict
 from datetime import timedelta
-
-
-# 创建并返回相应类型的频道对象
-def create_channel_object():
-    # 从配置中获取频道类型
-    channel_type = conf().get("channel_type")
-    # 根据频道类型创建相应的频道对象
-    if channel_type in ['wechat', 'wx', 'wxy']:
-        return WechatChannel(), ReplyType.IMAGE, 1
-    elif channel_type == 'wechatmp':
-        return WechatMPChannel(), ReplyType.IMAGE_URL, 2
-    elif channel_type == 'wechatmp_service':
-        return WechatMPChannel(), ReplyType.IMAGE_URL, 2
-    elif channel_type == 'wechatcom_app':
-        return WechatComAppChannel(), ReplyType.IMAGE_URL, 2
-    elif channel_type == 'wework':
-        from channel.wework.wework_channel import WeworkChannel
-        return WeworkChannel(), ReplyType.IMAGE_URL, 2
-    elif channel_type == 'weworktop':
-        from channel.weworktop.weworktop_channel import WeworkChannel
-        return WeworkChannel(), ReplyType.IMAGE_URL, 2
-    elif channel_type == 'ntchat':
-        from channel.wechatnt.ntchat_channel import NtchatChannel
-        return NtchatChannel(), ReplyType.IMAGE_URL, 2
-    else:
-        return WechatChannel(), ReplyType.IMAGE, 1
+from urllib.parse import urlparse
 
 
 # 对内容进行格式化处理
@@ -73,63 +62,148 @@ def format_content(content):
     return prompt, commands
 
 
-# 根据内容生成提示信息
-def generate_prompt(content):
+# 根据内容生成提示信息，timeout为请求超时秒数
+def generate_prompt(content, timeout=None):
     # 创建提示信息的内容
     message_content = "请根据AI生图关键词'{}'预测想要得到的画面，然后用英文拓展描述、丰富细节、添加关键词描述以适用于AI生图。描述要简短直接突出重点，请把优化后的描述直接返回，不需要多余的语言！".format(
         content)
+    # 第一次优化提示词时才导入openai
+    import openai
     # 创建一个openai聊天完成的对象，并获取返回的内容
     completion = openai.ChatCompletion.create(model=conf().get("model"), messages=[
-        {"role": "user", "content": message_content}], max_tokens=300, temperature=0.8, top_p=0.9)
+        {"role": "user", "content": message_content}], max_tokens=300, temperature=0.8, top_p=0.9,
+        request_timeout=timeout)
     prompt = completion['choices'][0]['message']['content']
     logger.debug("优化后的关键词：{}".format(prompt))
     return prompt
 
 
-# 将图片转换为base64编码的字符串
-def convert_base64(image):
-    # 打开图片文件
-    with open(image, "rb") as image_file:
-        # 对图片内容进行base64编码
-        encoded_string = base64.b64encode(image_file.read())
-    return encoded_string.decode('utf-8')
-
-
-# 下载并压缩图片
-def download_and_compress_image(url, filename, quality=30):
-    # 确定保存图片的目录
-    directory = os.path.join(os.getcwd(), "tmp")
-    # 如果目录不存在，则创建目录
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-
-    # 下载图片
-    response = requests.get(url)
-    image = Image.open(io.BytesIO(response.content))
-
-    # 压缩图片
-    image_path = os.path.join(directory, f"{filename}.jpg")
-    image.save(image_path, "JPEG", quality=quality)
-
-    return image_path
-
-
-# 带有重试机制的发送消息
-def send_with_retry(comapp, com_reply, e_context, max_retries=3, delay=2):
-    # 尝试发送消息，如果失败则重试
-    for i in range(max_retries):
-        try:
-            # 尝试发送消息
-            comapp.send(com_reply, e_context['context'])
-            break  # 如果成功发送，就跳出循环
-        except requests.exceptions.SSLError as e:
-            # 如果因为SSL错误而发送失败，记录错误并重试
-            logger.error(f"Failed to send message due to SSL error: {e}. Attempt {i + 1} of {max_retries}")
-            if i < max_retries - 1:  # 如果不是最后一次尝试，那么等待一段时间再重试
-                time.sleep(delay)  # 等待指定的秒数
-            else:
-                # 如果尝试发送消息的次数达到了最大次数，记录错误并放弃
-                logger.error(f"Failed to send message after {max_retries} attempts. Giving up.")
+# 缩小并重新编码上传的图片，返回编码后的数据和对应的MIME类型
+def shrink_image(image, max_size=1536, quality=85):
+    """
+    将上传的图片最长边限制在max_size以内，并重新编码为更紧凑的格式
+
+    有透明通道的图片编码为PNG，其余编码为JPEG；如果图片无需缩小且重新编码后并不更小，则保留原图，不读入内存
+
+    参数:
+        image (str): 图片的本地路径
+        max_size (int): 最长边的像素上限
+        quality (int): JPEG压缩质量
+
+    返回:
+        (图片数据, MIME类型)，保留原图时图片数据为None
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(image) as img:
+        original_mime = Image.MIME.get(img.format, "image/png")
+        needs_resize = max(img.size) > max_size
+        has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        # 按EXIF方向旋转，重新编码后方向信息会丢失
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_size, max_size), reducing_gap=2.0)
+        buffer = io.BytesIO()
+        if has_alpha:
+            img.save(buffer, "PNG", optimize=True)
+            mime = "image/png"
+        else:
+            img.convert("RGB").save(buffer, "JPEG", quality=quality, optimize=True)
+            mime = "image/jpeg"
+
+    if not needs_resize and buffer.tell() >= os.path.getsize(image):
+        return None, original_mime
+    return buffer.getvalue(), mime
+
+
+# 常见图片格式的文件头 -> MIME类型
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+    (b"BM", "image/bmp"),
+)
+HEIF_BRANDS = {b"heic": "image/heic", b"heix": "image/heic", b"mif1": "image/heif", b"msf1": "image/heif",
+               b"avif": "image/avif"}
+
+
+# 根据文件头猜测图片的MIME类型，无法识别时按扩展名猜测，都无法识别时按PNG处理
+def guess_image_mime(image):
+    with open(image, "rb") as f:
+        header = f.read(16)
+    for signature, mime in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return mime
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header[4:8] == b"ftyp" and header[8:12] in HEIF_BRANDS:
+        return HEIF_BRANDS[header[8:12]]
+    mime, _ = mimetypes.guess_type(image)
+    return mime if mime and mime.startswith("image/") else "image/png"
+
+
+# 将上传的图片缩小、重新编码后作为图片来源，提交时以流式请求体逐块进行base64编码
+# PIL无法解码的图片（如HEIC或不完整的文件）直接以原文件上传，由代理判断能否使用
+def prepare_upload_image(image, max_size=1536, quality=85):
+    original_size = os.path.getsize(image)
+    try:
+        data, mime = shrink_image(image, max_size=max_size, quality=quality)
+    except OSError as e:
+        # PIL.UnidentifiedImageError和图片不完整时的错误都是OSError的子类
+        data, mime = None, guess_image_mime(image)
+        logger.warn("[RP] cannot decode upload image %s, sending original as %s: %s" % (image, mime, e))
+    if data is None:
+        source = ImageSource(mime=mime, path=image)
+    else:
+        source = ImageSource(mime=mime, data=data)
+    logger.info("[RP] upload image %s: %d -> %d bytes, saved %d bytes" % (
+        mime, original_size, source.size(), original_size - source.size()))
+    return source
+
+
+# 流式下载并压缩图片，返回内存中的JPEG数据，session为共享的HTTP会话
+def download_and_compress_image(url, quality=30, max_size=1024, session=requests, timeout=(5, 60),
+                                chunk_size=64 * 1024, spool_size=8 * 1024 * 1024, metrics=None, action="all"):
+    """
+    分块下载图片，缩小到目标尺寸后压缩为JPEG，返回内存中的数据，不在tmp目录留下文件
+
+    内存占用上限：min(原图大小, spool_size) + 原图解码后的位图（宽*高*通道数，JPEG原图按目标尺寸降采样解码）
+    + 压缩后的JPEG（通常几十到几百KB）。原图超过spool_size时转存到自动删除的临时文件。
+
+    参数:
+        url (str): 图片链接
+        quality (int): JPEG压缩质量
+        max_size (int): 最长边的像素上限
+        session: 共享的HTTP会话
+        timeout: （连接超时，读取超时）
+        chunk_size (int): 下载分块大小
+        spool_size (int): 原图在内存中缓存的字节上限
+        metrics (Metrics): 分别记录下载和压缩耗时（可选）
+        action (str): 记录耗时使用的任务类型
+
+    返回:
+        包含JPEG数据的BytesIO对象
+    """
+    from PIL import Image
+
+    with tempfile.SpooledTemporaryFile(max_size=spool_size) as spool:
+        # 分块下载，避免一次性把整个响应读入内存
+        with metrics.timer("download", action) if metrics else nullcontext():
+            with session.get(url, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    spool.write(chunk)
+        spool.seek(0)
+
+        with metrics.timer("compress", action) if metrics else nullcontext(), Image.open(spool) as image:
+            # thumbnail对JPEG使用draft降采样解码，其他格式解码后尽早缩小
+            image.thumbnail((max_size, max_size), reducing_gap=2.0)
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            image_storage = io.BytesIO()
+            image.save(image_storage, "JPEG", quality=quality, optimize=True)
+
+    image_storage.seek(0)
+    return image_storage
 
 
 # 使用装饰器注册一个名为"Midjourney_Turbo"的插件
@@ -144,10 +218,8 @@ class MidjourneyTurbo(Plugin):
         try:
             # 获取当前文件的目录
             curdir = os.path.dirname(__file__)
-            # 配置文件的路径
-            config_path = os.path.join(curdir, "config.json")
-            # 创建一个过期字典，有效期为1小时
-            self.params_cache = ExpiredDict(60 * 60)
+            # 配置文件的路径，可以通过环境变量MIDJOURNEY_TURBO_CONFIG指定（如性能测试时使用独立的配置）
+            config_path = os.environ.get("MIDJOURNEY_TURBO_CONFIG") or os.path.join(curdir, "config.json")
             # 如果配置文件不存在
             if not os.path.exists(config_path):
                 # 输出日志信息，配置文件不存在，将使用模板
@@ -158,15 +230,15 @@ class MidjourneyTurbo(Plugin):
             with open(config_path, "r", encoding="utf-8") as f:
                 # 加载 JSON 文件
                 config = json.load(f)
-                rootdir = os.path.dirname(os.path.dirname(curdir))
+                # 数据库和暂存文件默认保存在项目主目录下，data_dir可以指定其他目录
+                rootdir = config.get("data_dir") or os.path.dirname(os.path.dirname(curdir))
                 dbdir = os.path.join(rootdir, "db")
                 if not os.path.exists(dbdir):
                     os.mkdir(dbdir)
                 logger.info("[verify_turbo] inited")
                 user_db = os.path.join(dbdir, "user.db")
-                self.user_db = sqlite3.connect(user_db, check_same_thread=False)
-                # 创建频道对象
-                self.comapp, self.type, self.num = create_channel_object()
+                # 按频道类型获取频道对象，第一次发送消息时才导入对应的频道模块
+                self.comapp, self.type, self.num = resolve_channel(conf().get("channel_type"))
                 # 获取配置文件中的各种参数
                 self.api_key = config.get("api_key", "")
                 self.domain_name = config["domain_name"]
@@ -174,19 +246,131 @@ class MidjourneyTurbo(Plugin):
                 self.blend_ins = config.get("blend_ins", "/b")
                 self.change_ins = config.get("change_ins", "/c")
                 self.split_url = config.get("split_url", False)
+                self.stats_ins = config.get("stats_ins", "/stats")
+                self.admin_users = config.get("admin_users", [])
+                # 按阶段和任务类型统计耗时和事件次数，管理员可在私聊中查看，也可以导出为Prometheus格式
+                self.metrics = Metrics()
+                if config.get("metrics_file") or config.get("metrics_port"):
+                    MetricsExporter(self.metrics, path=config.get("metrics_file", ""),
+                                    port=config.get("metrics_port", 0)).start()
+                # 可选记录请求到达的匿名轨迹，用于按真实流量回放压力测试
+                self.trace_recorder = None
+                if config.get("trace_file"):
+                    self.trace_recorder = TraceRecorder(config["trace_file"], image_ins=self.image_ins,
+                                                        blend_ins=self.blend_ins, change_ins=self.change_ins,
+                                                        stats_ins=self.stats_ins,
+                                                        max_bytes=config.get("trace_max_mb", 50) * 1024 * 1024)
+                # 消息在后台按会话顺序发送，频道发送缓慢或失败时不阻塞出图，最终失败的消息记录到死信文件
+                self.delivery = DeliveryQueue(send=lambda reply, context: self.comapp.send(reply, context),
+                                              workers=config.get("delivery_workers", 4),
+                                              max_pending=config.get("delivery_max_pending", 1000),
+                                              max_attempts=config.get("delivery_attempts", 4),
+                                              dead_letter_path=os.path.join(dbdir, "midjourney_dead_letter.jsonl"),
+                                              metrics=self.metrics)
+                # 可选在出图进度经过指定节点时发送低分辨率预览，同一会话限制发送频率
+                self.preview_limiter = None
+                if config.get("preview_milestones"):
+                    self.preview_limiter = PreviewLimiter(milestones=config["preview_milestones"],
+                                                          interval=config.get("preview_interval", 30))
+                self.preview_poll_interval = config.get("preview_poll_interval", 5)
+                self.preview_max_size = config.get("preview_max_size", 384)
+                self.preview_quality = config.get("preview_quality", 25)
                 self.short_url_api = config.get("short_url_api", "")
+                # 配置short_url_base时使用内置短链接，否则使用外部短链接接口，结果按图片链接缓存
+                self.short_urls = None
+                self.short_url_timeout = config.get("short_url_timeout", 5)
+                if config.get("short_url_base"):
+                    shortener = LocalShortener(db_path=os.path.join(dbdir, "midjourney_short_url.db"),
+                                               base_url=config["short_url_base"],
+                                               retention=config.get("short_url_days", 30) * 86400)
+                    self.short_urls = ShortUrlCache(shorten=shortener.shorten)
+                    # 重定向服务也可以由其他进程或反向代理提供，short_url_port为0时不启动
+                    if config.get("short_url_port"):
+                        self.short_url_server = ShortUrlServer(shortener, port=config["short_url_port"],
+                                                               host=config.get("short_url_host", "0.0.0.0"))
+                        self.short_url_server.start()
+                elif self.short_url_api:
+                    self.short_urls = ShortUrlCache(
+                        shorten=lambda url: self.get_short_url(short_url_api=self.short_url_api, url=url))
                 self.default_params = config.get("default_params", {"action": "IMAGINE:出图", "prompt": ""})
                 self.gpt_optimized = config.get("gpt_optimized", False)
+                # GPT优化结果缓存，相同的输入和模型直接复用优化后的提示词
+                self.prompt_cache = PromptCache(db_path=os.path.join(dbdir, "midjourney_prompt.db"),
+                                                ttl=config.get("prompt_cache_ttl", 7 * 24 * 60 * 60))
+                # GPT优化的等待上限，超时后直接使用原始提示词，可选在较短延迟后发起第二个请求
+                self.prompt_optimizer = PromptOptimizer(generate=lambda content, timeout: generate_prompt(content, timeout),
+                                                        cache=self.prompt_cache,
+                                                        budget=config.get("gpt_timeout", 10),
+                                                        hedge_delay=config.get("gpt_hedge_delay", 0))
                 self.trial_lock = config.get("trial_lock", 3)
                 self.lock = config.get("lock", False)
                 self.group_lock = config.get("group_lock", False)
+                # 使用次数限制，启动时建表，每次扣减是一条原子语句，可选内存计数定期写回
+                self.usage_limiter = UsageLimiter(db_path=user_db, trial_lock=self.trial_lock,
+                                                  write_behind=config.get("usage_write_behind", False))
                 self.local_data = threading.local()
                 self.complete_prompt = config.get("complete_prompt", "任务完成！")
-                # 创建 MidJourneyModule 对象
-                self.mm = MidJourneyModule(api_key=self.api_key, domain_name=self.domain_name)
+                self.image_max_size = config.get("image_max_size", 1024)
+                self.upload_max_size = config.get("upload_max_size", 1536)
+                self.upload_quality = config.get("upload_quality", 85)
+                # 垫图和合图的待处理会话，内存中只保存参数，上传的图片暂存到磁盘，闲置超时或超出上限时提前清理
+                self.params_cache = SessionStore(spool_dir=os.path.join(rootdir, "tmp", "midjourney_turbo_spool"),
+                                                 ttl=config.get("session_ttl", 600),
+                                                 max_bytes=config.get("session_max_mb", 200) * 1024 * 1024,
+                                                 max_user_bytes=config.get("session_user_max_mb", 50) * 1024 * 1024)
+                # 压缩后的结果图片缓存，重复发送同一任务时直接读取磁盘
+                self.result_cache = ResultCache(directory=os.path.join(rootdir, "tmp", "midjourney_turbo"),
+                                                max_bytes=config.get("result_cache_mb", 200) * 1024 * 1024)
+                # 创建代理后端，回调地址附带随机token，回调监听只接受带有该token的请求
+                self.notify_hook = config.get("notify_hook", "")
+                self.notify_secret = config.get("notify_secret") or secrets.token_urlsafe(24)
+                if self.notify_hook:
+                    hook = urlparse(self.notify_hook)
+                    query = "&".join(filter(None, [hook.query, "token=" + self.notify_secret]))
+                    self.notify_hook = hook._replace(query=query).geturl()
+                # 共享的HTTP连接池，代理接口、短链接口和图片下载都复用keep-alive连接
+                self.session = create_session(pool_size=config.get("http_pool_size", 20))
+                self.timeout = (config.get("connect_timeout", 5), config.get("read_timeout", 120.05))
+                # 本地记录已提交和已结束的任务，变换前先在本地校验任务ID，结果可以重新发送
+                self.task_store = TaskStore(db_path=os.path.join(dbdir, "midjourney_task.db"),
+                                            retention=config.get("task_store_days", 30) * 86400)
+                # domain_name可以配置多个代理，新任务发送到负载最低的健康代理，变换任务发送到原任务所在的代理
+                backends = parse_backends(self.domain_name, self.api_key,
+                                          max_in_flight=config.get("max_in_flight", 3))
                 # 如果 domain_name 为空或包含"你的域名"，则抛出异常
-                if not self.domain_name or "你的域名" in self.domain_name:
+                if not backends:
                     raise Exception("please set your Midjourney domain_name in config or environment variable.")
+                # 代理连续失败后熔断，熔断期间直接提示，不再等待超时；查询接口失败时在重试预算内退避重试
+                self.mm = BackendPool(backends, owner_lookup=self.task_store.backend,
+                                      probe_interval=config.get("backend_probe_interval", 30),
+                                      notify_hook=self.notify_hook, session=self.session, timeout=self.timeout,
+                                      failure_threshold=config.get("breaker_failures", 5),
+                                      reset_timeout=config.get("breaker_reset", 30),
+                                      max_retries=config.get("fetch_retries", 2))
+                # 开启回调后轮询只作为兜底，使用更长的间隔
+                poll_interval = config.get("notify_poll_interval", 60) if self.notify_hook \
+                    else config.get("poll_interval", 10)
+                poll_min_interval = poll_interval if self.notify_hook else config.get("poll_min_interval", 2)
+                # 按任务类型统计出图耗时，在预计完成时间附近密集查询，统计结果保存在db目录下
+                self.latency_model = LatencyModel(path=os.path.join(dbdir, "midjourney_latency.json"))
+                # 提交调度队列，同时执行的任务数为所有代理的并发数之和，按用户轮询，变换任务使用快速通道
+                self.scheduler = SubmitScheduler(max_in_flight=self.mm.capacity(),
+                                                 reserved_change=config.get("reserved_change_slots", 1),
+                                                 max_queue=config.get("max_queue", 100))
+                # 合并时间内相同提示词（及图片）的任务只提交一次，结果发送给所有请求者
+                self.coalescer = Coalescer(window=config.get("coalesce_window", 60))
+                # 创建后台任务引擎，事件处理函数提交任务后立即返回
+                self.task_engine = TaskEngine(mm=self.mm, max_workers=config.get("task_workers", 4),
+                                              poll_interval=poll_interval, latency_model=self.latency_model,
+                                              min_interval=poll_min_interval)
+                # 如果配置了回调地址，启动内置的回调监听，由midjourney-proxy推送任务状态
+                if self.notify_hook:
+                    self.notify_server = NotifyServer(poller=self.task_engine.poller,
+                                                      host=config.get("notify_host", "127.0.0.1"),
+                                                      port=config.get("notify_port", 8090),
+                                                      path=urlparse(self.notify_hook).path or "/",
+                                                      secret=self.notify_secret)
+                    self.notify_server.start()
             # 设置事件处理函数
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
             # 输出日志信息，表示插件已初始化
@@ -210,9 +394,22 @@ class MidjourneyTurbo(Plugin):
         logger.info("[RP] image_query={}".format(e_context['context'].content))
         # 创建一个回复对象
         reply = Reply()
+        self.local_data.arrival = time.time()
         try:
             # 获取会话ID
             user_id = e_context['context']["session_id"]
+            # 记录请求轨迹，待处理会话中的图片在下载后记录尺寸
+            if self.trace_recorder and not (e_context['context'].type == ContextType.IMAGE
+                                            and user_id in self.params_cache):
+                self.trace_recorder.record(e_context['context'], arrival=self.local_data.arrival)
+            # 管理员查看运行统计，不计入使用次数
+            if e_context['context'].type == ContextType.IMAGE_CREATE and \
+                    e_context['context'].content.strip() == self.stats_ins:
+                reply.type = ReplyType.TEXT
+                reply.content = self.get_stats_text() if self.is_admin(e_context) else "⚠️仅管理员可以在私聊中查看运行统计"
+                e_context['reply'] = reply
+                e_context.action = EventAction.BREAK_PASS
+                return
             # 获取事件内容
             content = e_context['context'].content[:]
 
@@ -222,20 +419,14 @@ class MidjourneyTurbo(Plugin):
                     logger.debug("使用限制已开启.")
                     if e_context["context"]["isgroup"]:
                         if self.group_lock:
-                            continue_a, continue_b, remaining = self.check_and_update_usage_limit(
-                                trial_lock=self.trial_lock,
-                                user_id=user_id,
-                                db_conn=self.user_db)
+                            continue_a, continue_b, remaining = self.usage_limiter.check_and_update(user_id)
                             logger.debug(
                                 f"群聊锁已开启. continue_a={continue_a}, continue_b={continue_b}, remaining={remaining}")
                         else:
                             continue_a, continue_b, remaining = True, False, ""
                             logger.debug("群聊锁未开启，直接放行.")
                     else:
-                        continue_a, continue_b, remaining = self.check_and_update_usage_limit(
-                            trial_lock=self.trial_lock,
-                            user_id=user_id,
-                            db_conn=self.user_db)
+                        continue_a, continue_b, remaining = self.usage_limiter.check_and_update(user_id)
                         logger.debug(
                             f"非群聊上下文. continue_a={continue_a}, continue_b={continue_b}, remaining={remaining}")
                 else:
@@ -245,6 +436,8 @@ class MidjourneyTurbo(Plugin):
                 continue_a, continue_b, remaining = True, False, ""
                 logger.debug("收到图像信息，继续执行.")
 
+            # 记录本次消息是否扣减了使用次数，没有向代理提交任务时退还
+            self.local_data.charged = continue_a and continue_b
             if continue_a and continue_b:
                 self.local_data.reminder_string = f"\n💳您的绘画试用次数剩余：{remaining}次"
             elif not continue_a and not continue_b:
@@ -293,9 +486,9 @@ class MidjourneyTurbo(Plugin):
         if self.image_ins in prompt:
             # 移除图片插入标记
             prompt = prompt.replace(self.image_ins, "")
-            prompt = generate_prompt(content=prompt) if self.gpt_optimized else prompt
+            prompt = self.optimize_prompt(content=prompt) if self.gpt_optimized else prompt
             # 将params添加到用户的参数缓存中
-            self.params_cache[user_id] = {'image_params': params}
+            self.params_cache.create(user_id, {'image_params': params, 'charged': self.local_data.charged})
 
             # 向params中的prompt添加内容
             if params.get("prompt", ""):
@@ -336,11 +529,8 @@ class MidjourneyTurbo(Plugin):
                 return
 
             # 添加用户的合成参数到params_cache
-            self.params_cache[user_id] = {'blend_params': params, 'num_pictures': num_pictures,
-                                          'base64_data': []}
-
-            # 记录调试日志
-            logger.debug(f"self.params_cache_2:{self.params_cache}")
+            self.params_cache.create(user_id, {'blend_params': params, 'num_pictures': num_pictures,
+                                               'charged': self.local_data.charged})
 
             # 向params中的prompt添加内容
             if params.get("prompt", ""):
@@ -359,263 +549,139 @@ class MidjourneyTurbo(Plugin):
             submit_uv = ' '.join(prompt.replace(self.change_ins, "").strip().split())
             logger.debug("[RP] submit_uv post_json={}".format(" ".join(submit_uv)))
 
-            # 检查输入的格式是否正确
-            pattern = re.compile(r'^\d+\s[vVuU]\d$')
+            # 检查输入的格式是否正确，只有任务ID时重新发送该任务的结果
+            pattern = re.compile(r'^\d+(\s[vVuU]\d)?$')
             if not pattern.match(submit_uv):
+                self.refund_usage(user_id)
                 trigger = conf()['image_create_prefix'][0]
                 reply.type = ReplyType.ERROR
                 reply.content = f"格式不正确。请使用如下示例格式：\n{trigger} {self.change_ins} 8528881058085979 V1"
             else:
                 # 解析输入的值
-                number, v_value = submit_uv.split()
+                number, _, v_value = submit_uv.partition(" ")
                 logger.debug("Parsed values: Number: {}, V value: {}".format(number, v_value))
                 v_value_upper = v_value.upper()
-                # 确保UV值在U1-U4和V1-V4范围内
-                if v_value_upper in ["U1", "U2", "U3", "U4", "V1", "V2", "V3", "V4"]:
-                    simple_data = self.mm.get_simple(content=number + " " + v_value_upper)
-
-                    # 发送任务提交消息
-                    self.send_task_submission_message(e_context, messageId=simple_data["result"])
-
-                    # 获取图片的URL
-                    task_data = self.mm.get_image_url(id=simple_data["result"])
-                    if task_data["failReason"] is None:
-
-                        # 生成新的URL
-                        new_url = self.generate_new_url(task_data=task_data)
-
-                        # 生成短URL
-                        short_url = self.get_short_url(short_url_api=self.short_url_api, url=new_url)
-
-                        # 计算时间差
-                        time_diff_start_finish_td, time_diff_submit_finish_td = self.get_time_diff(task_data)
-
-                        logger.debug("new_url: %s" % new_url)
-
-                        # 创建一个新的回复
-                        com_reply = self.create_reply(new_url=new_url, data=simple_data)
-
-                        # 发送回复
-                        send_with_retry(self.comapp, com_reply, e_context)
-
-                        logger.debug("The comapp object is an instance of: " + type(self.comapp).__name__)
+                # 先在本地校验任务ID，未知或失败的任务不再请求代理
+                status, task_data = self.task_store.get(number)
+                # 没有在后台等待的未完成任务（如结果查询失败或插件重启过），向所在后端查询一次
+                if status == "SUBMITTED" and not self.task_engine.tracking(number):
+                    status, task_data = self.refresh_task(number, status)
+                if status is None:
+                    self.refund_usage(user_id)
+                    reply.type = ReplyType.TEXT
+                    reply.content = "任务ID不存在，请检查后重新输入"
+                elif status == "FAILURE":
+                    self.refund_usage(user_id)
+                    reply.type = ReplyType.TEXT
+                    reply.content = f"该任务未成功，无法操作：{task_data.get('failReason') or '未知原因'}"
+                elif not v_value_upper:
+                    # 只重新发送结果时不会提交新任务，退还使用次数
+                    self.refund_usage(user_id)
+                    if task_data is None:
                         reply.type = ReplyType.TEXT
-
-                        # 设置回复内容
-                        reply.content = self.complete_prompt.format(id=simple_data["result"],
-                                                                    change_ins=self.change_ins, imgurl=short_url,
-                                                                    start_finish=time_diff_start_finish_td,
-                                                                    submit_finish=time_diff_submit_finish_td)
-
-                        logger.debug("Sent image URL and completed prompt.")
+                        reply.content = "该任务还未完成，请您耐心等待..."
                     else:
-                        reply.type = ReplyType.TEXT
-                        reply.content = task_data["failReason"]
-                        logger.debug("Sent failReason as reply content.")
+                        # 使用本地记录的任务结果重新发送，不请求代理
+                        self.task_engine.redeliver(number, lambda data: self.deliver_task_result(
+                            e_context, {"result": number}, data), task_data)
+                # 确保UV值在U1-U4和V1-V4范围内
+                elif v_value_upper in ["U1", "U2", "U3", "U4", "V1", "V2", "V3", "V4"]:
+                    # 变换任务进入快速通道排队提交
+                    action = "UPSCALE" if v_value_upper.startswith("U") else "VARIATION"
+                    self.schedule_task(e_context, user_id, reply,
+                                       submit=lambda: self.mm.get_simple(content=number + " " + v_value_upper),
+                                       lane=LANE_CHANGE, delay=0, action=action,
+                                       coalesce_key="%s:%s %s" % (action, number, v_value_upper))
         else:
             # 如果没有识别到特定的指令，则执行默认的操作，生成一个新的图像
             logger.debug("Generating prompt...")
-            prompt = generate_prompt(content=prompt) if self.gpt_optimized else prompt
+            prompt = self.optimize_prompt(content=prompt) if self.gpt_optimized else prompt
             prompt += commands
             logger.debug(f"Generated prompt: {prompt}")
 
             logger.debug("Getting imagination data...")
-            imagine_data = self.mm.get_imagine(prompt=prompt)
-            if isinstance(imagine_data, str):
-                # 如果返回的是错误消息，则直接发送错误消息
-                reply.type = ReplyType.TEXT
-                reply.content = f"任务提交失败，{imagine_data}"
-                logger.error(f"Received error message: {imagine_data}")
-            else:
-                self.send_task_submission_message(e_context, messageId=imagine_data["result"])
-                logger.debug(f"Received imagination data: {imagine_data}")
-
-                time.sleep(10)  # 等待一段时间，以确保任务已经处理完成
-
-                logger.debug("Getting image URL...")
-                task_data = self.mm.get_image_url(id=imagine_data["result"])
-                logger.debug(f"Received task data: {task_data}")
-                if isinstance(task_data, str):
-                    # 错误信息响应
-                    reply.type = ReplyType.TEXT
-                    reply.content = task_data
-                    logger.error(f"Received error message: {task_data}")
-                else:
-                    # 正常的JSON响应
-                    if task_data["failReason"] is None:
-                        # 处理图片链接
-                        new_url = self.generate_new_url(task_data=task_data)
-                        # 生成短链接
-                        short_url = self.get_short_url(short_url_api=self.short_url_api, url=new_url)
-                        # 计算时间差
-                        time_diff_start_finish_td, time_diff_submit_finish_td = self.get_time_diff(
-                            task_data)
-
-                        logger.debug("new_url: %s" % new_url)
-
-                        com_reply = self.create_reply(new_url=new_url, data=imagine_data)
-
-                        # 发送回复
-                        send_with_retry(self.comapp, com_reply, e_context)
-
-                        reply.type = ReplyType.TEXT
-
-                        # 设置回复内容
-                        reply.content = self.complete_prompt.format(id=imagine_data["result"],
-                                                                    change_ins=self.change_ins,
-                                                                    imgurl=short_url,
-                                                                    start_finish=time_diff_start_finish_td,
-                                                                    submit_finish=time_diff_submit_finish_td)
-
-                        logger.debug("Sent image URL and completed prompt.")
-                    else:
-                        reply.type = ReplyType.TEXT
-                        reply.content = task_data["failReason"]
-                        logger.debug("Sent failReason as reply content.")
+            self.schedule_task(e_context, user_id, reply, submit=lambda: self.mm.get_imagine(prompt=prompt),
+                               coalesce_key="IMAGINE:" + prompt)
         # 设置回复内容和动作
         e_context['reply'] = reply
         e_context.action = EventAction.BREAK_PASS  # 事件结束后，跳过处理context的默认逻辑
         logger.debug("Event action set to BREAK_PASS, reply set.")
 
     def handle_params_cache(self, e_context, user_id, content, reply):
+        # 获取用户待处理的会话参数，会话中只保存参数和暂存图片的路径
+        img_params = self.params_cache.get(user_id)
+        if img_params is None:
+            return
+        # 使用次数在发送指令时已经扣减
+        self.local_data.charged = img_params.get('charged', False)
         # 如果参数缓存中存在对应用户的图像参数
-        if 'image_params' in self.params_cache[user_id]:
+        if 'image_params' in img_params:
             cmsg = e_context['context']['msg']
-            logger.debug("params_cache：%s" % self.params_cache)
             logger.debug("user_id in self.params_cache[user_id]")
-            img_params = self.params_cache[user_id]
-            del self.params_cache[user_id]  # 删除已使用的参数缓存
             cmsg.prepare()
+            self.record_trace_image(e_context)
 
-            # 将用户的输入转换为 base64 编码
-            base64_data = convert_base64(content)
-            base64_data = 'data:image/png;base64,' + base64_data
-
-            # 使用这些参数生成一个新的图像
-            imagine_data = self.mm.get_imagine(prompt=img_params['image_params']["prompt"], base64_data=base64_data)
-
-            if isinstance(imagine_data, str):  # 如果返回错误信息，则直接发送错误信息
+            # 将图片复制到暂存目录后取出会话，排队期间不再接收该用户的图片
+            error = self.params_cache.add_file(user_id, content)
+            paths = self.params_cache.detach(user_id)
+            if error:
+                self.params_cache.release(paths)
                 reply.type = ReplyType.TEXT
-                reply.content = f"任务提交失败，{imagine_data}"
-                logger.error(f"Received error message: {imagine_data}")
-            else:
-                # 否则，获取新的图像链接，并将其发送给用户
-                self.send_task_submission_message(e_context, messageId=imagine_data["result"])
-                logger.debug(f"Received imagination data: {imagine_data}")
-
-                time.sleep(10)  # 等待一段时间以确保任务已经处理完成
-
-                logger.debug("Getting image URL...")
-                task_data = self.mm.get_image_url(id=imagine_data["result"])
-                logger.debug(f"Received task data: {task_data}")
-                if isinstance(task_data, str):  # 错误信息响应
-                    reply.type = ReplyType.TEXT
-                    reply.content = task_data
-                    logger.error(f"Received error message: {task_data}")
-                else:  # 正常的JSON响应
-                    if task_data["failReason"] is None:
-                        # 处理图片链接
-                        new_url = self.generate_new_url(task_data=task_data)
-
-                        # 生成短链接
-                        short_url = self.get_short_url(short_url_api=self.short_url_api, url=new_url)
-
-                        # 计算时间差
-                        time_diff_start_finish_td, time_diff_submit_finish_td = self.get_time_diff(task_data)
-
-                        logger.debug("new_url: %s" % new_url)
-
-                        com_reply = self.create_reply(new_url=new_url, data=imagine_data)
-                        # 发送回复
-                        send_with_retry(self.comapp, com_reply, e_context)
-
-                        reply.type = ReplyType.TEXT
-
-                        # 设置回复内容
-                        reply.content = self.complete_prompt.format(id=imagine_data["result"],
-                                                                    change_ins=self.change_ins, imgurl=short_url,
-                                                                    start_finish=time_diff_start_finish_td,
-                                                                    submit_finish=time_diff_submit_finish_td)
+                reply.content = f"任务提交失败，{error}"
+                return
 
-                        logger.debug("Sent image URL and completed prompt.")
-                    else:
-                        reply.type = ReplyType.TEXT
-                        reply.content = task_data["failReason"]
-                        logger.debug("Sent failReason as reply content.")
-        elif 'num_pictures' in self.params_cache[user_id]:
+            # 提交时将图片缩小、重新编码，再逐块进行 base64 编码，提交后删除暂存的图片
+            prompt = img_params['image_params']["prompt"]
+            self.schedule_task(e_context, user_id, reply,
+                               submit=lambda: self.mm.get_imagine(prompt=prompt,
+                                                                  base64_data=self.prepare_upload(paths[0])),
+                               cleanup=lambda: self.params_cache.release(paths),
+                               coalesce_key="IMAGINE:%s:%s" % (prompt, file_digest(paths[0])))
+        elif 'num_pictures' in img_params:
             cmsg = e_context['context']['msg']
-            logger.debug("params_cache：%s" % self.params_cache)
-            logger.debug("user_id in self.params_cache[user_id]")
+            logger.debug("user_id in self.params_cache[user_id], session stats: %s" % self.params_cache.stats())
             cmsg.prepare()
+            self.record_trace_image(e_context)
 
-            # 获取当前用户的图像参数
-            img_params = self.params_cache[user_id]
-
-            # 将用户的输入转换为 base64 编码
-            base64_data = convert_base64(content)
-            base64_data = 'data:image/png;base64,' + base64_data
-
-            # 将新的 base64 数据添加到列表中
-            img_params['base64_data'].append(base64_data)
+            # 将图片复制到暂存目录，提交前才转换为 base64 编码
+            error = self.params_cache.add_file(user_id, content)
+            if error:
+                self.params_cache.discard(user_id)
+                reply.type = ReplyType.TEXT
+                reply.content = f"任务提交失败，{error}"
+                return
 
             # 减少待收集的图片数量
             img_params['num_pictures'] -= 1
 
-            # 如果收集到足够数量的图片，调用函数并清除用户数据
+            # 如果收集到足够数量的图片，排队提交并清除用户数据，提交后再删除暂存的图片
             if img_params['num_pictures'] == 0:
-                blend_data = self.mm.submit_blend(img_params['base64_data'])
-                del self.params_cache[user_id]  # 删除已使用的参数缓存
-
-                if isinstance(blend_data, str):
-                    reply.type = ReplyType.TEXT
-                    reply.content = f"任务提交失败，{blend_data}"
-                    logger.error(f"Received error message: {blend_data}")
-                else:
-                    # 获取混合后的图像链接，并将其发送给用户
-                    self.send_task_submission_message(e_context, messageId=blend_data["result"])
-                    logger.debug(f"Received imagination data: {blend_data}")
-                    time.sleep(10)  # 等待一段时间以确保任务已经处理完成
-                    logger.debug("Getting image URL...")
-                    task_data = self.mm.get_image_url(id=blend_data["result"])
-                    logger.debug(f"Received task data: {task_data}")
-
-                    if isinstance(task_data, str):
-                        # 错误信息响应
-                        reply.type = ReplyType.TEXT
-                        reply.content = task_data
-                        logger.error(f"Received error message: {task_data}")
-                    else:
-                        # 正常的JSON响应
-                        if task_data["failReason"] is None:
-                            # 处理图片链接
-                            new_url = self.generate_new_url(task_data=task_data)
-
-                            # 生成短链接
-                            short_url = self.get_short_url(short_url_api=self.short_url_api, url=new_url)
-
-                            # 计算时间差
-                            time_diff_start_finish_td, time_diff_submit_finish_td = self.get_time_diff(
-                                task_data)
-
-                            logger.debug("new_url: %s" % new_url)
-
-                            com_reply = self.create_reply(new_url=new_url, data=blend_data)
-
-                            # 发送回复
-                            send_with_retry(self.comapp, com_reply, e_context)
-
-                            reply.type = ReplyType.TEXT
-                            # 设置回复内容
-                            reply.content = self.complete_prompt.format(id=blend_data["result"],
-                                                                        change_ins=self.change_ins,
-                                                                        imgurl=short_url,
-                                                                        start_finish=time_diff_start_finish_td,
-                                                                        submit_finish=time_diff_submit_finish_td)
-                            logger.debug("Sent image URL and completed prompt.")
-                        else:
-                            reply.type = ReplyType.TEXT
-                            reply.content = task_data["failReason"]
-                            logger.debug("Sent failReason as reply content.")
+                paths = self.params_cache.detach(user_id)
+                self.schedule_task(e_context, user_id, reply,
+                                   submit=lambda: self.mm.submit_blend([self.prepare_upload(path) for path in paths]),
+                                   action="BLEND", cleanup=lambda: self.params_cache.release(paths),
+                                   coalesce_key="BLEND:" + ",".join(file_digest(path) for path in paths))
+
+    # 是否为管理员私聊，管理员包括godcmd认证的用户和配置中的admin_users
+    def is_admin(self, e_context):
+        context = e_context['context']
+        if context.kwargs.get('isgroup'):
+            return False
+        user = context.kwargs.get('receiver')
+        return user in global_config.get("admin_users", []) or user in self.admin_users
+
+    # 生成运行统计文本
+    def get_stats_text(self):
+        lines = [self.metrics.render_text(),
+                 "🧮调度队列：%s" % self.scheduler.stats(),
+                 "🔗任务合并：%s" % self.coalescer.stats(),
+                 "🖥代理：%s" % self.mm.stats(),
+                 "💾结果缓存：%s，提示词缓存：%s" % (self.result_cache.stats(), self.prompt_cache.stats()),
+                 "🔗短链接：%s" % (self.short_urls.stats() if self.short_urls else "未开启"),
+                 "📤发送队列：%s" % self.delivery.stats(),
+                 "🖼进度预览：%s" % (self.preview_limiter.stats() if self.preview_limiter else "未开启"),
+                 "⏳等待出图：%d" % self.task_engine.in_flight()]
+        return "\n".join(lines)
 
     # 定义一个方法，用于生成帮助文本
     def get_help_text(self, verbose=False, **kwargs):
@@ -631,15 +697,24 @@ class MidjourneyTurbo(Plugin):
         if not verbose:
             return help_text
         # 否则，添加详细的使用方法到帮助文本中
-        help_text += f"使用方法:\n使用\"{trigger}[内容描述]\"的格式作画，如\"{trigger}一个中国漂亮女孩\"\n垫图指令：{trigger} {self.image_ins}，合图指令：{trigger} {self.blend_ins}\n垫图指令后面可以加关键词，合图指令后面不需要加"
+        help_text += f"使用方法:\n使用\"{trigger}[内容描述]\"的格式作画，如\"{trigger}一个中国漂亮女孩\"\n垫图指令：{trigger} {self.image_ins}，合图指令：{trigger} {self.blend_ins}\n垫图指令后面可以加关键词，合图指令后面不需要加\n变换指令：{trigger} {self.change_ins} 任务ID U1，只发送任务ID可重新获取出图结果"
         # 返回帮助文本
         return help_text
 
+    # 使用GPT优化提示词，优先读取缓存，超出等待时间时使用原始提示词，action为记录耗时使用的任务类型
+    def optimize_prompt(self, content, action="IMAGINE"):
+        with self.metrics.timer("gpt", action):
+            prompt = self.prompt_optimizer.optimize(content, conf().get("model"))
+        if prompt is None:
+            logger.info("[RP] use raw prompt, optimizer stats: %s" % self.prompt_optimizer.stats())
+            return content
+        return prompt
+
     def get_short_url(self, short_url_api, url):
         # 检查是否提供了短网址 API
         if short_url_api != "":
             # 发送POST请求到短网址 API，并传入原始网址
-            response = requests.post(short_url_api, json={"url": url})
+            response = self.session.post(short_url_api, json={"url": url}, timeout=self.timeout)
             data = response.json()
             # 构建完整的短网址，将API基本URL与响应中的键值连接起来
             short_url = short_url_api + data["key"]
@@ -674,67 +749,278 @@ class MidjourneyTurbo(Plugin):
 
         return time_diff_start_finish_td_sec, time_diff_submit_finish_td_sec
 
-    def send_task_submission_message(self, e_context, messageId):
+    # 发送任务提交消息，messageId为空时发送排队位置，reminder_string为空时使用当前线程的剩余次数提示
+    def send_task_submission_message(self, e_context, messageId=None, queue_position=0, reminder_string=None):
         com_reply = Reply()
         com_reply.type = ReplyType.TEXT
         context = e_context['context']
+        if reminder_string is None:
+            reminder_string = self.local_data.reminder_string
+        if messageId is None:
+            content = "🕒您的绘图任务已进入队列！\n👥前面还有{position}个任务，轮到您时会自动提交...".format(
+                position=queue_position - 1)
+        else:
+            content = "☑️您的绘图任务提交成功！\n🆔ID：{id}\n⏳正在努力出图，请您耐心等待...".format(id=messageId)
         if context.kwargs.get('isgroup'):
             msg = context.kwargs.get('msg')
             nickname = msg.actual_user_nickname  # 获取昵称
-            com_reply.content = "@{name}\n☑️您的绘图任务提交成功！\n🆔ID：{id}\n⏳正在努力出图，请您耐心等待...".format(
-                name=nickname, id=messageId) + self.local_data.reminder_string
+            com_reply.content = "@{name}\n".format(name=nickname) + content + reminder_string
         else:
-            com_reply.content = "☑️您的绘图任务提交成功！\n🆔ID：{id}\n⏳正在努力出图，请您耐心等待...".format(
-                id=messageId) + self.local_data.reminder_string
-        self.comapp.send(com_reply, context)
-
-    def check_and_update_usage_limit(self, trial_lock, user_id, db_conn):
-        cur = db_conn.cursor()
-
-        # 确保midjourneyturbo表存在
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS midjourneyturbo
-            (UserID TEXT PRIMARY KEY, TrialCount INTEGER, TrialDate TEXT);
-        """)
-        db_conn.commit()
-
-        # 从数据库中查询用户
-        cur.execute("""
-            SELECT TrialCount, TrialDate FROM midjourneyturbo 
-            WHERE UserID = ?
-        """, (user_id,))
-        row = cur.fetchone()
-
-        # 如果用户不存在，插入一个新用户并设置试用次数和日期，然后返回True和试用次数减1
-        if row is None:
-            trial_count = trial_lock - 1  # 试用次数减1
-            cur.execute("""
-                INSERT INTO midjourneyturbo (UserID, TrialCount, TrialDate) VALUES (?, ?, ?)
-            """, (user_id, trial_count, datetime.date.today().isoformat()))  # 插入用户，并设置当前日期和试用次数
-            db_conn.commit()
-            return True, True, trial_count
-
-        # 用户存在于数据库中，检查试用次数和日期
-        trial_count = row[0] if row and row[0] is not None else trial_lock
-        trial_date = row[1] if row and row[1] is not None else None
-        today = datetime.date.today().isoformat()
-
-        if trial_count == 0 and trial_date == today:  # 今天的试用次数已经用完
-            return False, False, ""
-
-        if trial_count > 0 and trial_date == today:  # 试用次数有剩余，并且日期是今天
-            trial_count -= 1  # 减少试用次数
-        else:  # 试用次数为0或者日期不是今天
-            trial_count = trial_lock - 1  # 重置试用次数并减去1
-            trial_date = today  # 更新试用日期
-
-        cur.execute("""
-            UPDATE midjourneyturbo 
-            SET TrialCount = ?, TrialDate = ?
-            WHERE UserID = ?
-        """, (trial_count, trial_date, user_id))
-        db_conn.commit()
-        return True, True, trial_count
+            com_reply.content = content + reminder_string
+        self.delivery.enqueue(com_reply, context)
+
+    # 记录已下载图片的到达时间和尺寸
+    def record_trace_image(self, e_context):
+        if self.trace_recorder:
+            self.trace_recorder.record(e_context['context'], arrival=self.local_data.arrival)
+
+    # 将提交任务放入调度队列，有空闲名额时立即在后台提交，否则发送排队位置，处理函数不等待提交结果
+    # coalesce_key相同的任务在合并时间内只提交一次，后来的请求者与发起者一起接收结果
+    def schedule_task(self, e_context, user_id, reply, submit, lane=LANE_IMAGINE, delay=10, action="IMAGINE",
+                      cleanup=None, coalesce_key=None):
+        reminder_string = self.local_data.reminder_string
+        subscriber = (e_context, reminder_string)
+        scheduled = time.time()
+        self.metrics.incr("requests", action)
+        flight = None
+        if coalesce_key is not None and self.coalescer.window > 0:
+            flight, role = self.coalescer.join(coalesce_key, user_id, subscriber)
+            logger.debug("[RP] coalescer %s, stats: %s" % (role, self.coalescer.stats()))
+            if role != "leader":
+                self.metrics.incr("coalesced", action)
+                if cleanup:
+                    cleanup()
+                if role == "duplicate":
+                    # 重复发送的任务不会再次提交，退还本次扣减的使用次数
+                    remaining = self.refund_usage(user_id)
+                    if remaining is not None:
+                        reminder_string = f"\n💳您的绘画试用次数剩余：{remaining}次"
+                    reply.type = ReplyType.TEXT
+                    reply.content = "⏳您的相同绘图任务正在进行中，请耐心等待..." + reminder_string
+                elif flight["task_id"]:
+                    self.send_task_submission_message(e_context, messageId=flight["task_id"],
+                                                      reminder_string=reminder_string)
+                else:
+                    reply.type = ReplyType.TEXT
+                    reply.content = "☑️相同的绘图任务正在排队，出图后会一并发送给您..." + reminder_string
+                return
+
+        # 获取任务结束时接收结果的对象，未合并的任务只有发起者本人
+        def subscribers():
+            return self.coalescer.finish(flight) if flight else [subscriber]
+
+        def submit_job():
+            self.metrics.observe("wait_local", time.time() - scheduled, action)
+            try:
+                with self.metrics.timer("submit", action):
+                    submit_data = submit()
+            except Exception as e:
+                # 图片处理或请求过程中的意外错误，同样通知所有请求者
+                self.metrics.incr("submit_error", action)
+                logger.exception(f"[RP] submit failed: {e}")
+                for context, _ in subscribers():
+                    self.send_text(context, f"任务提交失败，{e}")
+                return False
+            finally:
+                if cleanup:
+                    cleanup()
+            if isinstance(submit_data, ProxyError):
+                # 如果返回的是错误消息，则直接发送错误消息
+                self.metrics.incr("submit_" + submit_data.kind, action)
+                logger.error(f"Received error message: {submit_data}")
+                for context, _ in subscribers():
+                    self.send_text(context, f"任务提交失败，{submit_data}")
+                return False
+            self.metrics.incr("submitted", action)
+            self.task_store.submitted(submit_data["result"], action, backend=submit_data.get("backend"))
+            # 通知排队期间合并进来的请求者
+            if flight:
+                for context, reminder in self.coalescer.submitted(flight, submit_data["result"])[1:]:
+                    self.send_task_submission_message(context, messageId=submit_data["result"],
+                                                      reminder_string=reminder)
+            # 发送任务提交消息，交给后台任务引擎等待出图，任务结束后释放名额
+            self.track_task(e_context, submit_data, delay=delay, action=action, reminder_string=reminder_string,
+                            on_finish=lambda: self.scheduler.release(lane), subscribers=subscribers,
+                            scheduled=scheduled)
+            return True
+
+        # 任务没有交给后台任务引擎时（提交失败或中途出错），立即结束合并记录，避免后来的相同任务一直等待
+        def job():
+            handed_off = False
+            try:
+                handed_off = submit_job()
+                return handed_off
+            finally:
+                if flight and not handed_off:
+                    self.coalescer.finish(flight)
+
+        position = self.scheduler.submit(user_id, lane, job)
+        if position < 0:
+            self.metrics.incr("rejected", action)
+            reply.type = ReplyType.TEXT
+            reply.content = "当前排队的任务过多，请稍后再试~~~"
+            for context, _ in subscribers()[1:]:
+                self.send_text(context, reply.content)
+            if cleanup:
+                cleanup()
+        elif position > 0:
+            self.send_task_submission_message(e_context, queue_position=position, reminder_string=reminder_string)
+        logger.debug("[RP] scheduler stats: %s" % self.scheduler.stats())
+
+    # 退还本次消息扣减的使用次数，用于没有向代理提交任务的回复，返回退还后的剩余次数，没有扣减时返回None
+    def refund_usage(self, user_id):
+        if not getattr(self.local_data, "charged", False):
+            return None
+        self.local_data.charged = False
+        return self.usage_limiter.refund(user_id)
+
+    # 向任务所在的后端查询一次任务，已结束时更新本地记录，查询失败或仍未结束时保持原状态
+    def refresh_task(self, task_id, status):
+        list_data = self.mm.list_by_condition([task_id])
+        if isinstance(list_data, ProxyError):
+            logger.warn("[RP] refresh task %s failed: %s" % (task_id, list_data))
+            return status, None
+        for task_data in list_data:
+            if task_data.get("id") == task_id and is_task_finished(task_data):
+                self.task_store.put(task_data)
+                return self.task_store.get(task_id)
+        return status, None
+
+    # 将暂存的上传图片缩小、重新编码为图片来源
+    def prepare_upload(self, path):
+        return prepare_upload_image(path, max_size=self.upload_max_size, quality=self.upload_quality)
+
+    # 发送任务提交消息，并把任务交给后台任务引擎，处理函数不再等待出图
+    # subscribers返回任务结束时接收结果的对象列表，为空时只发送给当前会话，scheduled为请求进入队列的时间
+    def track_task(self, e_context, submit_data, delay=0, action="IMAGINE", reminder_string=None, on_finish=None,
+                   subscribers=None, scheduled=None):
+        self.send_task_submission_message(e_context, messageId=submit_data["result"], reminder_string=reminder_string)
+        logger.debug(f"Received imagination data: {submit_data}")
+
+        def callback(task_data):
+            released = False
+            try:
+                if self.preview_limiter:
+                    self.preview_limiter.finish(submit_data["result"])
+                self.mm.release(submit_data["result"])
+                # 任务结束时代理的并发名额已经空出，立即释放本地名额，不等待下载、压缩和发送图片
+                released = True
+                if on_finish:
+                    on_finish()
+                self.record_task_metrics(action, task_data)
+                if not isinstance(task_data, ProxyError):
+                    self.task_store.put(task_data)
+                for context, _ in (subscribers() if subscribers else [(e_context, reminder_string)]):
+                    self.deliver_task_result(context, submit_data, task_data, action=action)
+                if scheduled is not None:
+                    self.metrics.observe("total", time.time() - scheduled, action)
+            finally:
+                if on_finish and not released:
+                    on_finish()
+
+        # 进度预览只发送给发起者，合并进来的请求者只接收最终结果
+        # 开启回调时由代理推送的进度唤醒查询，不再缩短轮询间隔
+        on_progress = None
+        if self.preview_limiter:
+            self.preview_limiter.start(submit_data["result"])
+            on_progress = lambda task_data: self.send_preview(e_context, task_data, action=action)
+        self.task_engine.track(submit_data["result"], callback, delay=delay, action=action, on_progress=on_progress,
+                               progress_interval=None if self.notify_hook else self.preview_poll_interval)
+
+    # 出图进度经过节点时发送压缩后的低分辨率预览
+    def send_preview(self, e_context, task_data, action="IMAGINE"):
+        progress = parse_progress(task_data.get("progress"))
+        if progress is None or not task_data.get("imageUrl"):
+            return
+        context = e_context['context']
+        conversation = context.kwargs.get("receiver") or context.kwargs.get("session_id")
+        if self.preview_limiter.due(task_data["id"], conversation, progress) is None:
+            return
+        reply = Reply()
+        reply.type = self.type
+        if self.num != 1:
+            reply.content = task_data["imageUrl"]
+        else:
+            with self.metrics.timer("preview", action):
+                reply.content = download_and_compress_image(task_data["imageUrl"], quality=self.preview_quality,
+                                                            max_size=self.preview_max_size, session=self.session,
+                                                            timeout=self.timeout)
+        # 下载期间任务已结束时不再发送，避免预览排在结果之后
+        if self.preview_limiter.active(task_data["id"]):
+            self.delivery.enqueue(reply, context, label="preview")
+
+    # 记录任务在代理中的排队和出图耗时
+    def record_task_metrics(self, action, task_data):
+        if isinstance(task_data, ProxyError):
+            self.metrics.incr("task_" + task_data.kind, action)
+            return
+        if task_data.get("status") != "SUCCESS":
+            self.metrics.incr("failed", action)
+            return
+        self.metrics.incr("succeeded", action)
+        if task_data.get("submitTime") and task_data.get("startTime") and task_data.get("finishTime"):
+            self.metrics.observe("proxy_queue", (task_data["startTime"] - task_data["submitTime"]) / 1000, action)
+            self.metrics.observe("render", (task_data["finishTime"] - task_data["startTime"]) / 1000, action)
+
+    # 通过发送队列发送文本消息，群聊中需要手动@用户，后台发送不会经过频道的回复装饰
+    def send_text(self, e_context, content):
+        reply = Reply()
+        reply.type = ReplyType.TEXT
+        reply.content = content
+        context = e_context['context']
+        if context.kwargs.get('isgroup'):
+            reply.content = "@{name}\n".format(name=context.kwargs.get('msg').actual_user_nickname) + reply.content
+        self.delivery.enqueue(reply, context)
+
+    # 后台任务结束后，发送图片和完成提示，action为记录耗时使用的任务类型，未指定时使用任务数据中的类型
+    def deliver_task_result(self, e_context, submit_data, task_data, action=None):
+        logger.debug(f"Received task data: {task_data}")
+        if isinstance(task_data, ProxyError):
+            # 错误信息响应
+            content = str(task_data)
+            logger.error(f"Received error message: {task_data}")
+        elif task_data["failReason"] is None:
+            # 处理图片链接
+            action = action or task_data.get("action") or "all"
+            new_url = self.generate_new_url(task_data=task_data)
+            # 在后台生成短链接，与图片发送同时进行
+            short_url_future = self.short_urls.submit(new_url) if self.short_urls else None
+            # 计算时间差
+            time_diff_start_finish_td, time_diff_submit_finish_td = self.get_time_diff(task_data)
+
+            logger.debug("new_url: %s" % new_url)
+
+            # 图片先于完成提示入队，同一会话按顺序发送；图片处理失败时仍然发送带原图链接的完成提示
+            try:
+                com_reply = self.create_reply(new_url=new_url, data=submit_data, action=action)
+                self.delivery.enqueue(com_reply, e_context['context'], label="image")
+            except Exception as e:
+                logger.exception("[RP] failed to deliver image %s: %s" % (new_url, e))
+
+            # 图片处理完成后等待短链接，超时使用原始链接
+            short_url = self.wait_short_url(short_url_future, new_url, action=action)
+            # 设置完成提示内容
+            content = self.complete_prompt.format(id=submit_data["result"],
+                                                  change_ins=self.change_ins, imgurl=short_url,
+                                                  start_finish=time_diff_start_finish_td,
+                                                  submit_finish=time_diff_submit_finish_td)
+            logger.debug("Sent image URL and completed prompt.")
+        else:
+            content = task_data["failReason"]
+            logger.debug("Sent failReason as reply content.")
+        self.send_text(e_context, content)
+
+    # 等待后台生成的短链接，耗时统计只包含图片处理完成后仍需等待的时间
+    def wait_short_url(self, future, url, action="all"):
+        if future is None:
+            return url
+        with self.metrics.timer("short_url", action):
+            try:
+                return future.result(timeout=self.short_url_timeout)
+            except Exception as e:
+                logger.error("[RP] short url for %s not ready: %r" % (url, e))
+                self.metrics.incr("short_url_timeout", action)
+                return url
 
     def generate_new_url(self, task_data):
         if self.split_url:
@@ -744,15 +1030,20 @@ class MidjourneyTurbo(Plugin):
             new_url = task_data["imageUrl"]
         return new_url
 
-    def create_reply(self, new_url, data):
+    def create_reply(self, new_url, data, action="all"):
         com_reply = Reply()
         com_reply.type = self.type
 
         if self.num != 1:
             com_reply.content = new_url
         else:
-            # 下载并压缩图片
-            image_path = download_and_compress_image(new_url, data['result'])
-            image_storage = open(image_path, 'rb')
-            com_reply.content = image_storage
+            # 优先使用缓存，未命中时流式下载并压缩图片，直接使用内存中的数据发送
+            variant = f"jpeg{self.num}_{self.image_max_size}"
+            image_data = self.result_cache.get(data['result'], new_url, variant)
+            if image_data is None:
+                image_data = download_and_compress_image(new_url, max_size=self.image_max_size,
+                                                         session=self.session, timeout=self.timeout,
+                                                         metrics=self.metrics, action=action).getvalue()
+                self.result_cache.put(data['result'], new_url, variant, image_data)
+            com_reply.content = io.BytesIO(image_data)
         return com_reply